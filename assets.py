@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""Static assets build step.
+
+Bundles stylesheets, names every built file after a hash of its contents
+and stores gzip (and brotli, when the module is installed) compressed
+variants next to it, so they can be cached by browsers forever:
+
+    python3 assets.py
+
+Files are written to static/build along with manifest.json mapping source
+names to built ones; templates refer to assets by source names through
+asset_urls().
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import re
+from flask import Blueprint, current_app, request, send_from_directory
+from flask import url_for, abort
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'static')
+BUILD_DIR = os.path.join(STATIC_DIR, 'build')
+MANIFEST_NAME = 'manifest.json'
+
+# Stylesheets bundled into one file, in the order of inclusion
+BUNDLES = {
+    'css/catalog.css': ['css/font-awesome.min.css', 'css/bootstrap.min.css',
+                        'css/bootstrap-social.css', 'css/main.css'],
+}
+FONTS_DIR = 'fonts'
+# woff and woff2 fonts are compressed already
+COMPRESSED_EXTENSIONS = ('.css', '.svg', '.ttf', '.eot', '.otf')
+HASH_LENGTH = 12
+
+CSS_URL_RE = re.compile(r"""url\((['"]?)\.\./fonts/([^'"?#)]+)""")
+CSS_COMMENT_RE = re.compile(r'/\*(?!!).*?\*/', re.DOTALL)
+
+CACHE_MAX_AGE = 365 * 24 * 60 * 60
+CACHE_CONTROL = 'public, max-age={}, immutable'.format(CACHE_MAX_AGE)
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def fingerprint(name, content):
+    """Returns name with hash of content inserted before extension"""
+    base, extension = os.path.splitext(name)
+    digest = hashlib.sha256(content).hexdigest()[:HASH_LENGTH]
+    return '{}.{}{}'.format(base, digest, extension)
+
+
+def minify_css(text):
+    """Drops comments (except /*! license ones) and indentation"""
+    text = CSS_COMMENT_RE.sub('', text)
+    lines = (line.strip() for line in text.splitlines())
+    return '\n'.join(line for line in lines if line)
+
+
+def write_asset(build_dir, name, content):
+    path = os.path.join(build_dir, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as asset_file:
+        asset_file.write(content)
+    if not name.endswith(COMPRESSED_EXTENSIONS):
+        return
+    with open(path + '.gz', 'wb') as asset_file:
+        asset_file.write(gzip.compress(content, 9))
+    if brotli is not None:
+        with open(path + '.br', 'wb') as asset_file:
+            asset_file.write(brotli.compress(content))
+
+
+def build(static_dir=STATIC_DIR, build_dir=BUILD_DIR):
+    """Builds all assets and returns the manifest. Files of previous
+    builds are kept for pages cached before deployment"""
+    manifest = {}
+
+    for font in sorted(os.listdir(os.path.join(static_dir, FONTS_DIR))):
+        name = '{}/{}'.format(FONTS_DIR, font)
+        with open(os.path.join(static_dir, name), 'rb') as font_file:
+            content = font_file.read()
+        manifest[name] = fingerprint(name, content)
+        write_asset(build_dir, manifest[name], content)
+
+    def replace_font_url(match):
+        quote, font = match.groups()
+        built = manifest['{}/{}'.format(FONTS_DIR, font)]
+        return 'url({}../{}'.format(quote, built)
+
+    for bundle, sources in sorted(BUNDLES.items()):
+        parts = []
+        for source in sources:
+            with open(os.path.join(static_dir, source)) as css_file:
+                parts.append(CSS_URL_RE.sub(replace_font_url,
+                                            minify_css(css_file.read())))
+        content = '\n'.join(parts).encode('utf-8')
+        manifest[bundle] = fingerprint(bundle, content)
+        write_asset(build_dir, manifest[bundle], content)
+
+    with open(os.path.join(build_dir, MANIFEST_NAME), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+    logging.info("Built {} assets{}".format(
+        len(manifest), '' if brotli else " (brotli is not installed)"))
+    return manifest
+
+
+def load_manifest(build_dir):
+    """Returns manifest of built assets, or None if they were not built"""
+    try:
+        with open(os.path.join(build_dir, MANIFEST_NAME)) as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return None
+
+
+assets = Blueprint('assets', __name__)
+
+
+def asset_urls(name):
+    """Returns URLs of asset (or bundle) by its source name. Without
+    built assets files are served one by one from static directory"""
+    manifest = current_app.extensions['assets_manifest']
+    if manifest is None:
+        return [url_for('static', filename=source)
+                for source in BUNDLES.get(name, [name])]
+    return [url_for('assets.send_asset', filename=manifest[name])]
+
+
+def accepted_encodings():
+    accepted = set()
+    for part in request.headers.get('Accept-Encoding', '').split(','):
+        coding, _, params = part.strip().partition(';')
+        if params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00'):
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+@assets.route('/assets/<path:filename>')
+def send_asset(filename):
+    build_dir = current_app.config['ASSETS_BUILD_DIR']
+    if filename == MANIFEST_NAME or filename.endswith(('.gz', '.br')):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(filename)[0] or \
+        'application/octet-stream'
+    accepted = accepted_encodings()
+    encoding = None
+    for coding, extension in ENCODINGS:
+        if coding in accepted and \
+                os.path.isfile(os.path.join(build_dir, filename + extension)):
+            encoding = coding
+            filename += extension
+            break
+
+    response = send_from_directory(build_dir, filename, mimetype=mimetype,
+                                   cache_timeout=CACHE_MAX_AGE)
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    return response
+
+
+def init_app(app):
+    app.extensions['assets_manifest'] = \
+        load_manifest(app.config['ASSETS_BUILD_DIR'])
+    app.jinja_env.globals['asset_urls'] = asset_urls
+    app.register_blueprint(assets)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build static assets")
+    parser.add_argument('--static', default=STATIC_DIR)
+    parser.add_argument('--output', default=BUILD_DIR)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    build(args.static, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import bisect
+import logging
+import threading
+import time
+from database import session
+from database_setup import Book
+import changes
+import search
+
+
+class PrefixIndex(object):
+    """Sorted keys of book titles and authors, starting from every word
+    of them, for prefix lookups by bisection. Built in a background thread
+    when the process starts serving requests. Changes of books made by any
+    process are read from the change log, at most once per check_interval
+    seconds (right after commit for changes of this process), and applied
+    in place"""
+
+    # Bounds time spent on very short prefixes matching many books
+    MAX_SCANNED = 200
+    # Longer runs of logged changes are applied by rebuilding the index
+    MAX_CHANGES = 1000
+    # Requests coming before the index is built wait for it this long
+    BUILD_WAIT = 5
+
+    def __init__(self, check_interval=5):
+        self.check_interval = check_interval
+        # Guards keys, entries and books, which are read by complete()
+        self.lock = threading.Lock()
+        # Lets one thread at a time build the index or apply changes
+        self.update_lock = threading.Lock()
+        self.builder_lock = threading.Lock()
+        self.builder = None
+        self.keys = []
+        self.entries = []
+        self.books = {}
+        # Sequence number of the last change log entry applied
+        self.seq = None
+        self.checked_at = 0
+
+    @staticmethod
+    def make_keys(title, author):
+        """Yields (key, is_start_of_field) of every word suffix"""
+        for text in (title, author):
+            words = search.tokenize(text)
+            for number in range(len(words)):
+                yield ' '.join(words[number:]), number == 0
+
+    @classmethod
+    def make_index(cls, books):
+        """Returns keys, entries and books of index of (id, title, author)
+        of books"""
+        items = []
+        titles = {}
+        for book_id, title, author in books:
+            titles[book_id] = (title, author)
+            items.extend((key, book_id, is_start)
+                         for key, is_start in cls.make_keys(title, author))
+        items.sort()
+        return ([key for key, _, _ in items],
+                [(book_id, is_start) for _, book_id, is_start in items],
+                titles)
+
+    def build(self):
+        """Builds index of all books and swaps it in. Readers are not
+        blocked meanwhile"""
+        # Changes logged after this entry are applied again by update(),
+        # which is harmless
+        seq = changes.get_last_seq(session)
+        keys, entries, books = self.make_index(
+            session.query(Book.id, Book.title, Book.author))
+        with self.lock:
+            self.keys, self.entries, self.books = keys, entries, books
+        self.seq = seq
+
+    def add(self, book_id, title, author):
+        self.books[book_id] = (title, author)
+        for key, is_start in self.make_keys(title, author):
+            position = bisect.bisect_right(self.keys, key)
+            self.keys.insert(position, key)
+            self.entries.insert(position, (book_id, is_start))
+
+    def remove(self, book_id):
+        title, author = self.books.pop(book_id)
+        for key, _ in self.make_keys(title, author):
+            position = bisect.bisect_left(self.keys, key)
+            while self.entries[position][0] != book_id:
+                position += 1
+            del self.keys[position]
+            del self.entries[position]
+
+    def run_builder(self):
+        try:
+            with self.update_lock:
+                if self.seq is None:
+                    self.build()
+                    self.checked_at = time.time()
+        except Exception:
+            logging.exception("Failed to build autocomplete index")
+        finally:
+            session.remove()
+
+    def start(self):
+        """Starts building index in a background thread, unless it is
+        built or being built. Returns the building thread"""
+        with self.builder_lock:
+            if self.seq is None and (self.builder is None or
+                                     not self.builder.is_alive()):
+                self.builder = threading.Thread(target=self.run_builder)
+                self.builder.daemon = True
+                self.builder.start()
+            return self.builder
+
+    def update(self):
+        """Applies changes logged since the index was built or updated"""
+        if self.seq is None:
+            return
+        with self.update_lock:
+            logged = changes.get_changes(session, self.seq,
+                                         self.MAX_CHANGES + 1)
+            if len(logged) > self.MAX_CHANGES:
+                self.build()
+            elif logged:
+                book_ids = set(entry.book_id for entry in logged)
+                changed = {book_id: (title, author)
+                           for book_id, title, author in session.query(
+                               Book.id, Book.title, Book.author).filter(
+                                   Book.id.in_(book_ids))}
+                with self.lock:
+                    for book_id in book_ids:
+                        if book_id in self.books:
+                            self.remove(book_id)
+                        if book_id in changed:
+                            self.add(book_id, *changed[book_id])
+                self.seq = logged[-1].seq
+            self.checked_at = time.time()
+
+    def refresh(self):
+        if time.time() - self.checked_at >= self.check_interval:
+            self.update()
+
+    def complete(self, prefix, limit):
+        """Returns up to limit (id, title, author) of books whose title
+        or author has a word starting with prefix. Books with title or
+        author starting with prefix go first"""
+        prefix = ' '.join(search.tokenize(prefix))
+        if not prefix:
+            return []
+        if self.seq is None:
+            self.start().join(self.BUILD_WAIT)
+        self.refresh()
+        with self.lock:
+            position = bisect.bisect_left(self.keys, prefix)
+            end = min(position + self.MAX_SCANNED, len(self.keys))
+            matches = {}
+            while position < end and self.keys[position].startswith(prefix):
+                book_id, is_start = self.entries[position]
+                matches[book_id] = matches.get(book_id, False) or is_start
+                position += 1
+            books = self.books
+            ranked = sorted(matches, key=lambda book_id: (
+                not matches[book_id], books[book_id][0].lower(), book_id))
+            return [(book_id,) + books[book_id]
+                    for book_id in ranked[:limit]]
+
+
+index = PrefixIndex()
+
+
+def init_app(app):
+    global index
+    index = PrefixIndex(app.config['AUTOCOMPLETE_CHECK_INTERVAL'])
+    # Not at import, so that no thread is started before server forks
+    app.before_first_request(index.start)
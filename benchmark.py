@@ -0,0 +1,629 @@
+#!/usr/bin/env python3
+"""Load testing harness.
+
+Generates synthetic catalog and drives every route of the app at given
+concurrency, reporting throughput, latency percentiles and SQL queries per
+request of every route:
+
+    python3 benchmark.py --database sqlite:////tmp/bench.sqlite \\
+        --generate --books 100000 --concurrency 8 --requests 5000
+
+By default the app is served from this process, which competes with load
+generating threads for the interpreter. For more realistic numbers run the
+app separately, e.g.
+
+    gunicorn --workers 4 \\
+        "benchmark:create_benchmark_app('sqlite:////tmp/bench.sqlite')"
+
+and pass --url http://localhost:8000. Logged in users sign in through the
+fake OAuth provider served by the harness at --oauth-port. Book covers are
+fetched from the fake cover host served at --cover-port, which generates
+images of COVER_VARIANTS kinds.
+
+With --serialization the harness instead compares how many books per second
+JSON endpoints can load and encode through Book.serialize and through
+projection rows of serializers module.
+"""
+
+import argparse
+import datetime
+import io
+import json
+import math
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import requests
+from PIL import Image
+from sqlalchemy import create_engine, func, select
+from database_setup import Genre, Book, User
+import changes
+import migrations
+import stats
+
+
+WORDS = ("time person year way day thing man world life hand part child eye "
+         "woman place work week case point government company number group "
+         "problem fact dragon ship star planet river winter summer night "
+         "king queen castle forest ocean mountain city road war peace "
+         "secret shadow light storm fire stone heart memory garden").split()
+DEFAULT_OAUTH_PORT = 8999
+DEFAULT_COVER_PORT = 8998
+COVER_VARIANTS = 100
+# Widths of COVER_SIZES in common.py
+COVER_SIZES = (160, 320, 640)
+
+
+# Synthetic catalog
+
+def random_text(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def random_cover_url(rng, cover_host):
+    return '{}/covers/{}.jpg'.format(cover_host,
+                                     rng.randrange(COVER_VARIANTS))
+
+
+def generate_catalog(engine, genres, books, users, seed=0, batch_size=5000,
+                     cover_host="http://127.0.0.1:{}".format(
+                         DEFAULT_COVER_PORT)):
+    """Fills database with random genres, users and books, counting and
+    logging new books the way the app does. Covers of books are served
+    by the fake cover host at cover_host"""
+    rng = random.Random(seed)
+    migrations.upgrade(engine)
+    with engine.begin() as connection:
+        last_book_id = connection.execute(
+            select([func.max(Book.id)])).scalar() or 0
+        connection.execute(Genre.__table__.insert(), [
+            {'name': 'genre-{}'.format(number),
+             'description': random_text(rng, 12)}
+            for number in range(genres)])
+        connection.execute(User.__table__.insert(), [
+            {'name': 'User {}'.format(number),
+             'provider': 'benchmark',
+             'provider_id': str(number)}
+            for number in range(users)])
+        genre_ids = [row[0] for row in connection.execute(
+            Genre.__table__.select().with_only_columns([Genre.id]))]
+        user_ids = [row[0] for row in connection.execute(
+            User.__table__.select().with_only_columns([User.id]))]
+
+    created_at = datetime.datetime.utcnow()
+    for start in range(0, books, batch_size):
+        rows = [{'title': random_text(rng, 3).title(),
+                 'author': random_text(rng, 2).title(),
+                 'description': random_text(rng, 60),
+                 'year': rng.randint(1800, 2016),
+                 'cover_url': random_cover_url(rng, cover_host),
+                 'cover_url_attribution': "http://example.com/",
+                 'buy_url': "http://example.com/buy",
+                 'genre_id': rng.choice(genre_ids),
+                 'user_id': rng.choice(user_ids),
+                 'created_at': created_at}
+                for _ in range(min(batch_size, books - start))]
+        with engine.begin() as connection:
+            connection.execute(Book.__table__.insert(), rows)
+
+    with engine.begin() as connection:
+        stats.rebuild(connection)
+        changes.log_books_created(connection, [
+            row[0] for row in connection.execute(
+                select([Book.id]).where(Book.id > last_book_id))])
+
+
+def load_catalog_info(engine):
+    """Returns genre names and book id range to build requests from"""
+    with engine.connect() as connection:
+        genre_names = [row[0] for row in connection.execute(
+            Genre.__table__.select().with_only_columns([Genre.name]))]
+        max_book_id = connection.execute(
+            "SELECT max(id) FROM book").scalar() or 0
+    return genre_names, max_book_id
+
+
+# Fake OAuth provider
+
+class FakeOAuthHandler(BaseHTTPRequestHandler):
+    """Issues tokens for any code and returns a user per token"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path.startswith('/token'):
+            self.send_json({'access_token': 'token-{}'.format(
+                random.randint(0, 10 ** 9))})
+        else:
+            self.send_json({})
+
+    def do_GET(self):
+        token = self.headers.get('Authorization', '').split()[-1]
+        self.send_json({'id': token, 'name': 'Bench ' + token,
+                        'email': token + '@example.com'})
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def fake_provider_data(base_url):
+    return {
+        'fake': {
+            'auth_url': base_url + "/authorize?",
+            'access_token_url': base_url + "/token",
+            'oauth_url': base_url + "/",
+            'redirect_uri': "http://localhost/callback/fake",
+            'revoke_url': base_url + "/revoke",
+            'revoke_method': 'POST',
+            'client_id': "benchmark",
+            'client_secret': "benchmark",
+            'user_request': 'me',
+            'user_name_field': 'name',
+            'auth_header_name': 'bearer',
+            'scope': "identity",
+        }
+    }
+
+
+def start_in_thread(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return "http://{}:{}".format(*server.server_address)
+
+
+def start_fake_oauth(port):
+    return start_in_thread(ThreadingHTTPServer(('127.0.0.1', port),
+                                               FakeOAuthHandler))
+
+
+# Fake cover host
+
+def make_cover_image(variant):
+    """Returns JPEG of book cover size, colored after variant"""
+    rng = random.Random(variant)
+    image = Image.new('RGB', (800, 1200), tuple(
+        rng.randrange(256) for _ in range(3)))
+    for _ in range(20):
+        x, y = rng.randrange(800), rng.randrange(1200)
+        size = rng.randrange(1, 200)
+        image.paste(tuple(rng.randrange(256) for _ in range(3)),
+                    (x, y, x + size, y + size))
+    output = io.BytesIO()
+    image.save(output, 'JPEG', quality=90)
+    return output.getvalue()
+
+
+class FakeCoverHandler(BaseHTTPRequestHandler):
+    """Serves /covers/<variant>.jpg images, generating them on first
+    request"""
+
+    PATH_RE = re.compile(r'^/covers/(\d+)\.jpg$')
+    images = {}
+    lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        match = self.PATH_RE.match(self.path)
+        if not match:
+            self.send_error(404)
+            return
+        variant = int(match.group(1))
+        with self.lock:
+            if variant not in self.images:
+                self.images[variant] = make_cover_image(variant)
+            body = self.images[variant]
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_fake_covers(port):
+    return start_in_thread(ThreadingHTTPServer(('127.0.0.1', port),
+                                               FakeCoverHandler))
+
+
+# Application under test
+
+def create_benchmark_app(database_path,
+                         oauth_url="http://127.0.0.1:{}".format(
+                             DEFAULT_OAUTH_PORT)):
+    """Builds app reporting query counts, signing in with fake OAuth and
+    fetching covers from fake cover host"""
+    from main import create_app
+    return create_app({'DATABASE_PATH': database_path,
+                       'QUERY_COUNT_HEADER': True,
+                       'COVER_ALLOW_PRIVATE_HOSTS': True,
+                       'OAUTH_PROVIDER_DATA': fake_provider_data(oauth_url)})
+
+
+def start_app(database_path, oauth_url):
+    from werkzeug.serving import make_server, WSGIRequestHandler
+
+    class QuietRequestHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    app = create_benchmark_app(database_path, oauth_url)
+    return start_in_thread(make_server('127.0.0.1', 0, app, threaded=True,
+                                       request_handler=QuietRequestHandler))
+
+
+# Load generation
+
+STATE_RE = re.compile(r'/authorize\?[^"]*state=(\w+)')
+
+
+class Client(object):
+    """Browser-like client with its own cookies. Logged in client signs
+    in through fake provider and creates, edits and deletes own books"""
+
+    def __init__(self, base_url, genre_names, max_book_id, rng, logged_in,
+                 cover_host):
+        self.base_url = base_url
+        self.cover_host = cover_host
+        self.genre_names = genre_names
+        self.max_book_id = max_book_id
+        self.rng = rng
+        self.logged_in = logged_in
+        self.own_books = []
+        self.http = requests.Session()
+
+    def request(self, route, method, path, **kwargs):
+        started = time.time()
+        response = self.http.request(method, self.base_url + path,
+                                     allow_redirects=False, **kwargs)
+        elapsed = time.time() - started
+        queries = response.headers.get('X-Query-Count')
+        return (route, response.status_code, elapsed,
+                int(queries) if queries is not None else None, response)
+
+    def login(self):
+        result = self.request('show_login', 'GET', '/login')
+        state = STATE_RE.search(result[4].text).group(1)
+        callback = self.request('sign_in_with_provider', 'GET',
+                                '/callback/fake?state={}&code=benchmark'
+                                .format(state))
+        return [result, callback]
+
+    def logout(self):
+        return [self.request('logout', 'GET', '/logout/fake')]
+
+    def genre(self):
+        return self.rng.choice(self.genre_names)
+
+    def book_url(self):
+        return '/book/{}-Book'.format(self.rng.randint(1, self.max_book_id))
+
+    def book_form(self):
+        return {'book-title': random_text(self.rng, 3),
+                'book-image-url': random_cover_url(self.rng,
+                                                  self.cover_host),
+                'book-image-url-attribution': "http://example.com/",
+                'book-description': random_text(self.rng, 40),
+                'book-author': random_text(self.rng, 2),
+                'book-year': str(self.rng.randint(1800, 2016)),
+                'book-buy-url': "http://example.com/buy",
+                'book-genre': self.genre()}
+
+    def book_data(self):
+        """Returns book as JSON of batch operation"""
+        return {'title': random_text(self.rng, 3),
+                'cover_url': random_cover_url(self.rng, self.cover_host),
+                'cover_url_attribution': "http://example.com/",
+                'description': random_text(self.rng, 40),
+                'author': random_text(self.rng, 2),
+                'year': self.rng.randint(1800, 2016),
+                'buy_url': "http://example.com/buy",
+                'genre': self.genre()}
+
+    def read(self):
+        choice = self.rng.random()
+        if choice < 0.12:
+            return [self.request('show_homepage', 'GET', '/')]
+        if choice < 0.19:
+            return [self.request('show_homepage_json', 'GET', '/json')]
+        if choice < 0.22:
+            return [self.request('show_stats_json', 'GET', '/stats/json')]
+        if choice < 0.34:
+            path = '/genre/{}/'.format(self.genre())
+            return [self.request('show_genre', 'GET', path)]
+        if choice < 0.41:
+            after = self.rng.randint(0, self.max_book_id)
+            path = '/genre/{}/json?after={}'.format(self.genre(), after)
+            return [self.request('show_genre_json', 'GET', path)]
+        if choice < 0.56:
+            return [self.request('show_book', 'GET', self.book_url())]
+        if choice < 0.63:
+            return [self.request('show_book_json', 'GET',
+                                 self.book_url() + '/json')]
+        if choice < 0.67:
+            path = '/books/json?ids=' + ','.join(
+                str(self.rng.randint(1, self.max_book_id))
+                for _ in range(20))
+            return [self.request('show_books_json', 'GET', path)]
+        if choice < 0.71:
+            path = '/cover/{}/{}'.format(self.rng.randint(1, self.max_book_id),
+                                         self.rng.choice(COVER_SIZES))
+            return [self.request('show_cover', 'GET', path)]
+        if choice < 0.76:
+            path = '/search?q=' + self.rng.choice(WORDS)
+            return [self.request('show_search', 'GET', path)]
+        if choice < 0.81:
+            path = '/search/json?q=' + random_text(self.rng, 2)
+            return [self.request('show_search_json', 'GET', path)]
+        if choice < 0.89:
+            word = self.rng.choice(WORDS)
+            path = '/autocomplete?q=' + word[:self.rng.randint(1, len(word))]
+            return [self.request('autocomplete_books', 'GET', path)]
+        if choice < 0.93:
+            since = self.rng.randint(0, self.max_book_id)
+            path = '/changes/json?since={}'.format(since)
+            return [self.request('show_changes_json', 'GET', path)]
+        if choice < 0.96:
+            since = max(self.max_book_id - 100, 0)
+            path = '/catalog/export?since={}'.format(since)
+            return [self.request('export_catalog', 'GET', path)]
+        if choice < 0.99 and not self.logged_in:
+            return [self.request('show_login', 'GET', '/login')]
+        return [self.request('page_not_found', 'GET', '/missing/page')]
+
+    def write(self):
+        choice = self.rng.random()
+        if not self.own_books or choice < 0.3:
+            genre = self.genre()
+            results = [self.request('show_add_book', 'GET',
+                                    '/genre/{}/new-book'.format(genre))]
+            result = self.request('add_book_post_handler', 'POST',
+                                  '/genre/{}/new-book'.format(genre),
+                                  data=self.book_form())
+            location = result[4].headers.get('Location', '')
+            if '/book/' in location:
+                self.own_books.append(location.rsplit('/book/', 1)[1])
+            return results + [result]
+
+        if choice < 0.45:
+            return [self.batch()]
+
+        book_url = '/book/' + self.rng.choice(self.own_books)
+        if choice < 0.8:
+            return [
+                self.request('book_post_handler', 'POST', book_url,
+                             data={'book-edit': ''}),
+                self.request('show_edit_book', 'GET', book_url + '/edit'),
+                self.request('show_edit_book', 'POST', book_url + '/edit',
+                             data=self.book_form())]
+        self.own_books.remove(book_url[len('/book/'):])
+        return [self.request('show_delete_book', 'GET', book_url + '/delete'),
+                self.request('show_delete_book', 'POST',
+                             book_url + '/delete')]
+
+    def batch(self):
+        """Creates two books and updates one own book in one request"""
+        book_id = int(self.rng.choice(self.own_books).split('-', 1)[0])
+        operations = [{'action': 'create', 'book': self.book_data()},
+                      {'action': 'create', 'book': self.book_data()},
+                      {'action': 'update', 'id': book_id,
+                       'book': {'description': random_text(self.rng, 40)}}]
+        result = self.request('batch_books', 'POST', '/books/batch',
+                              json={'operations': operations})
+        if result[1] == 200:
+            for item in result[4].json()['results'][:2]:
+                self.own_books.append('{}-Book'.format(item['id']))
+        return result
+
+    def step(self, write_ratio):
+        if self.logged_in and self.rng.random() < write_ratio:
+            return self.write()
+        return self.read()
+
+
+def run_load(base_url, genre_names, max_book_id, concurrency, total_requests,
+             logged_in_ratio, write_ratio, cover_host, seed=0):
+    """Returns list of (route, status, seconds, queries) and wall time"""
+    results = []
+    results_lock = threading.Lock()
+    remaining = [total_requests]
+
+    def take(count):
+        with results_lock:
+            allowed = remaining[0] > 0
+            remaining[0] -= count
+            return allowed
+
+    def worker(number):
+        rng = random.Random(seed + number)
+        client = Client(base_url, genre_names, max_book_id, rng,
+                        logged_in=rng.random() < logged_in_ratio,
+                        cover_host=cover_host)
+        local = client.login() if client.logged_in else []
+        while take(1):
+            local.extend(client.step(write_ratio))
+        if client.logged_in:
+            local.extend(client.logout())
+        with results_lock:
+            results.extend(result[:4] for result in local)
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(worker, number)
+                       for number in range(concurrency)]:
+            future.result()
+    return results, time.time() - started
+
+
+# Serialization
+
+def serialize_orm(limit):
+    from flask import json as flask_json
+    from sqlalchemy.orm import joinedload
+    from database import session
+    books = session.query(Book).options(
+        joinedload(Book.genre), joinedload(Book.user)).order_by(
+            Book.id).limit(limit).all()
+    return flask_json.dumps({'books': [book.serialize for book in books]})
+
+
+def serialize_rows(limit):
+    import serializers
+    rows = serializers.query_book_rows().order_by(Book.id).limit(limit).all()
+    return serializers.encoder.encode(
+        {'books': serializers.serialize_rows(rows)})
+
+
+SERIALIZERS = (('Book.serialize', serialize_orm),
+               ('projection rows', serialize_rows))
+
+
+def run_serialization(database_path, rows, repeats):
+    """Measures rows/sec of loading and encoding books as JSON through ORM
+    objects and through projection rows. Returns {name: rows/sec}"""
+    from database import session
+    app = create_benchmark_app(database_path)
+    results = {}
+    with app.app_context():
+        for name, serialize in SERIALIZERS:
+            serialize(rows)  # warm up
+            timings = []
+            for _ in range(repeats):
+                started = time.time()
+                serialize(rows)
+                timings.append(time.time() - started)
+                session.remove()
+            results[name] = rows / min(timings)
+    return results
+
+
+# Reporting
+
+def percentile(sorted_values, fraction):
+    index = max(int(math.ceil(fraction * len(sorted_values))) - 1, 0)
+    return sorted_values[index]
+
+
+def summarize(results, wall_time):
+    by_route = defaultdict(list)
+    for result in results:
+        by_route[result[0]].append(result)
+    by_route['TOTAL'] = results
+
+    summary = {}
+    for route, route_results in sorted(by_route.items()):
+        latencies = sorted(result[2] for result in route_results)
+        queries = [result[3] for result in route_results
+                   if result[3] is not None]
+        summary[route] = {
+            'requests': len(route_results),
+            'errors': sum(1 for result in route_results if result[1] >= 500),
+            'throughput': len(route_results) / wall_time,
+            'p50_ms': percentile(latencies, 0.50) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            'queries': sum(queries) / len(queries) if queries else None,
+        }
+    return summary
+
+
+def print_summary(summary):
+    print("{:<24} {:>8} {:>6} {:>9} {:>9} {:>9} {:>9} {:>8}".format(
+        "route", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms",
+        "queries"))
+    for route, route_stats in summary.items():
+        queries = route_stats['queries']
+        print("{:<24} {:>8} {:>6} {:>9.1f} {:>9.2f} {:>9.2f} {:>9.2f} "
+              "{:>8}".format(route, route_stats['requests'],
+                             route_stats['errors'],
+                             route_stats['throughput'],
+                             route_stats['p50_ms'], route_stats['p95_ms'],
+                             route_stats['p99_ms'],
+                             '-' if queries is None
+                             else "{:.1f}".format(queries)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark book catalog")
+    parser.add_argument('--database', required=True,
+                        help="database URL, e.g. sqlite:////tmp/bench.sqlite")
+    parser.add_argument('--generate', action='store_true',
+                        help="fill database with synthetic catalog first")
+    parser.add_argument('--genres', type=int, default=20)
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--url', help="benchmark already running app "
+                                      "instead of serving it in-process")
+    parser.add_argument('--oauth-port', type=int, default=DEFAULT_OAUTH_PORT,
+                        help="port of fake OAuth provider")
+    parser.add_argument('--cover-port', type=int, default=DEFAULT_COVER_PORT,
+                        help="port of fake cover host; generated books "
+                             "refer to it")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--logged-in-ratio', type=float, default=0.2,
+                        help="share of clients signed in")
+    parser.add_argument('--write-ratio', type=float, default=0.05,
+                        help="share of write requests of signed in clients")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json-output',
+                        help="also save summary to this file for comparison")
+    parser.add_argument('--serialization', action='store_true',
+                        help="compare JSON serialization speed instead of "
+                             "running load")
+    parser.add_argument('--serialization-rows', type=int, default=5000)
+    parser.add_argument('--serialization-repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    engine = create_engine(args.database)
+    cover_host = "http://127.0.0.1:{}".format(args.cover_port)
+    if args.generate:
+        generate_catalog(engine, args.genres, args.books, args.users,
+                         args.seed, cover_host=cover_host)
+    genre_names, max_book_id = load_catalog_info(engine)
+    if not genre_names or not max_book_id:
+        parser.error("catalog is empty, use --generate")
+
+    if args.serialization:
+        results = run_serialization(args.database, args.serialization_rows,
+                                    args.serialization_repeats)
+        for name, rows_per_second in results.items():
+            print("{:<24} {:>12.0f} rows/s".format(name, rows_per_second))
+        if args.json_output:
+            with open(args.json_output, 'w') as output:
+                json.dump(results, output, indent=2, sort_keys=True)
+        return
+
+    oauth_url = start_fake_oauth(args.oauth_port)
+    start_fake_covers(args.cover_port)
+    base_url = args.url or start_app(args.database, oauth_url)
+    results, wall_time = run_load(base_url.rstrip('/'), genre_names,
+                                  max_book_id, args.concurrency,
+                                  args.requests, args.logged_in_ratio,
+                                  args.write_ratio, cover_host, args.seed)
+    summary = summarize(results, wall_time)
+    print_summary(summary)
+    if args.json_output:
+        with open(args.json_output, 'w') as output:
+            json.dump(summary, output, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
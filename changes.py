@@ -0,0 +1,87 @@
+"""Append-only log of book changes.
+
+Every insert, update and delete of a book appends an entry to book_change
+table in the same transaction, so mirrors of the catalog can fetch entries
+after the last one they have seen instead of the whole catalog. ORM changes
+are logged automatically; bulk inserts call log_books_created().
+
+Writers lock the 'changes' row of catalog_version before appending, so
+entries become visible in the order of their sequence numbers and readers
+never skip an entry committed late.
+"""
+
+import datetime
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from database_setup import Book, BookChange, CatalogVersion
+# Registers flush hooks of counters before the ones of this module, so
+# counters are always locked before the change log
+import stats
+import versions
+
+
+change_table = BookChange.__table__
+version_table = CatalogVersion.__table__
+
+CREATE = 'create'
+UPDATE = 'update'
+DELETE = 'delete'
+
+
+def lock_log(connection, now):
+    """Bumps version of the log, holding its row lock until commit"""
+    updated = connection.execute(version_table.update().where(
+        version_table.c.name == versions.CHANGES).values(
+            version=version_table.c.version + 1,
+            updated_at=now.replace(microsecond=0))).rowcount
+    if not updated:
+        connection.execute(version_table.insert().values(
+            name=versions.CHANGES, version=1,
+            updated_at=now.replace(microsecond=0)))
+
+
+def log_changes(connection, entries):
+    """Appends (book_id, action) entries to the log"""
+    if not entries:
+        return
+    now = datetime.datetime.utcnow()
+    lock_log(connection, now)
+    connection.execute(change_table.insert(), [
+        {'book_id': book_id, 'action': action, 'changed_at': now}
+        for book_id, action in entries])
+
+
+def log_books_created(connection, book_ids):
+    """Logs creation of books inserted without ORM"""
+    log_changes(connection, [(book_id, CREATE)
+                             for book_id in sorted(book_ids)])
+
+
+@event.listens_for(Session, 'after_flush')
+def log_book_changes(session, flush_context):
+    # Session collections still hold flushed objects here, and new books
+    # already have their ids
+    entries = []
+    for book in session.new:
+        if isinstance(book, Book):
+            entries.append((book.id, CREATE))
+    for book in session.dirty:
+        if isinstance(book, Book) and session.is_modified(book):
+            entries.append((book.id, UPDATE))
+    for book in session.deleted:
+        if isinstance(book, Book):
+            entries.append((book.id, DELETE))
+    log_changes(session.connection(), sorted(entries))
+
+
+def get_changes(db_session, since, limit):
+    """Returns up to limit log entries with sequence number greater than
+    since, oldest first"""
+    return db_session.query(BookChange).filter(
+        BookChange.seq > since).order_by(BookChange.seq).limit(limit).all()
+
+
+def get_last_seq(db_session):
+    """Returns sequence number of the latest entry, 0 for empty log"""
+    return db_session.query(BookChange.seq).order_by(
+        BookChange.seq.desc()).limit(1).scalar() or 0
@@ -1,2 +1,125 @@
-from secrets import DB_SECRET
+import os
+from secrets import DB_SECRET, FLASH_SECRET
+from oauth import OAUTH_PROVIDER_DATA
 DATABASE_PATH = "postgresql://catalog:{}@localhost/catalog".format(DB_SECRET)
+
+# Read-only requests are served by one of replicas, if any. Clients which
+# have just changed data read from the primary for DB_PRIMARY_PIN seconds
+DATABASE_REPLICA_PATHS = []
+DB_PRIMARY_PIN = 10
+
+# Maximum number of SQL queries a single request may issue. In strict mode
+# exceeding the budget fails the request instead of logging a warning.
+QUERY_BUDGET = 10
+QUERY_BUDGET_STRICT = False
+
+# Connection pool settings. Each process keeps up to
+# DB_POOL_SIZE + DB_MAX_OVERFLOW connections to the database, so size them
+# according to number of threads serving requests.
+DB_POOL_SIZE = 10
+DB_MAX_OVERFLOW = 10
+DB_POOL_TIMEOUT = 30
+DB_POOL_RECYCLE = 3600
+DB_POOL_PRE_PING = True
+
+SECRET_KEY = FLASH_SECRET
+
+# Number of books per page of genre listings; clients may request pages
+# up to MAX_PAGE_SIZE books with ?limit=N
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Number of books fetched from database at once by /catalog/export
+EXPORT_BATCH_SIZE = 500
+
+# Maximum number of books in one /books/json or /books/batch request
+BATCH_MAX_BOOKS = 1000
+
+# Cache of rendered pages and JSON responses, keyed by versions of the
+# pages, so book changes made by any process are seen at once. 'sqlite'
+# backend is shared by worker processes on the host; 'memory' backend is
+# private to a process. Entries older than RESPONSE_CACHE_TTL seconds are
+# not used (None keeps them until evicted).
+RESPONSE_CACHE_ENABLED = True
+RESPONSE_CACHE_BACKEND = 'sqlite'
+RESPONSE_CACHE_SIZE = 1000
+RESPONSE_CACHE_TTL = 300
+RESPONSE_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   'cache', 'responses.sqlite')
+
+# Sessions are kept on the server, cookies carry only their ids. 'memory'
+# backend is private to a process, so use it with one worker process only;
+# 'cookie' stores whole signed sessions in cookies instead
+SESSION_BACKEND = 'sqlite'
+SESSION_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'cache', 'sessions.sqlite')
+SESSION_TTL = 24 * 60 * 60
+SESSION_MAX_ENTRIES = 10000
+
+# Compiled templates are stored in TEMPLATE_BYTECODE_CACHE_PATH (None
+# disables it), so new worker processes do not compile them again.
+# Rendered fragments of pages (see {% cache %} in templates) are kept in
+# memory of every process, up to FRAGMENT_CACHE_SIZE of them (0 disables)
+TEMPLATE_BYTECODE_CACHE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'cache', 'templates')
+FRAGMENT_CACHE_SIZE = 500
+
+# Books suggested by /autocomplete by default. Its index lives in memory of
+# every process, which applies changes made by other processes from the
+# change log at most once per AUTOCOMPLETE_CHECK_INTERVAL seconds
+AUTOCOMPLETE_LIMIT = 10
+AUTOCOMPLETE_CHECK_INTERVAL = 5
+
+# Genres are kept in memory of every process; their version is checked at
+# most once per GENRE_REGISTRY_CHECK_INTERVAL seconds
+GENRE_REGISTRY_CHECK_INTERVAL = 5
+
+# Concurrent identical reads of books (book pages, genre pages, recent
+# additions) in a process run one query and share its result
+REQUEST_COALESCING = True
+
+# Optional per-process cache of most requested books (0 disables it).
+# Books changed by other processes may be served for up to BOOK_CACHE_TTL
+# seconds.
+BOOK_CACHE_SIZE = 0
+BOOK_CACHE_TTL = 30
+
+# HTTP clients of OAuth providers. Any of these settings may be overridden
+# for a single provider in OAUTH_PROVIDER_DATA with lowercase key without
+# OAUTH_ prefix, e.g. 'read_timeout': 5
+OAUTH_CONNECT_TIMEOUT = 3.05
+OAUTH_READ_TIMEOUT = 10
+OAUTH_RETRIES = 2
+OAUTH_RETRY_BACKOFF = 0.3
+OAUTH_POOL_SIZE = 10
+# Consecutive failures after which provider is not called for
+# OAUTH_CIRCUIT_RESET seconds
+OAUTH_CIRCUIT_FAILURES = 5
+OAUTH_CIRCUIT_RESET = 30
+
+# Prometheus metrics are served at /metrics. Requests slower than
+# SLOW_REQUEST_THRESHOLD seconds are logged with their SQL queries
+# (None disables the log)
+METRICS_ENABLED = True
+SLOW_REQUEST_THRESHOLD = 1.0
+
+# Book covers are fetched once and served from /cover/<book id>/<width>,
+# scaled down to one of COVER_SIZES widths. The least recently used ones are
+# removed from COVER_CACHE_PATH when they take more than
+# COVER_CACHE_MAX_BYTES; covers which failed to load are not fetched again
+# for COVER_RETRY_INTERVAL seconds. Covers are fetched from public addresses
+# only, unless COVER_ALLOW_PRIVATE_HOSTS (e.g. for local test servers)
+COVER_SIZES = (160, 320, 640)
+COVER_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'cache', 'covers')
+COVER_CACHE_MAX_BYTES = 200 * 1024 * 1024
+COVER_MAX_SOURCE_BYTES = 10 * 1024 * 1024
+COVER_CONNECT_TIMEOUT = 3.05
+COVER_READ_TIMEOUT = 10
+COVER_RETRY_INTERVAL = 60
+COVER_MAX_REDIRECTS = 3
+COVER_ALLOW_PRIVATE_HOSTS = False
+
+# Output of assets.py, served from /assets/
+ASSETS_BUILD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'static', 'build')
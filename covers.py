@@ -0,0 +1,391 @@
+"""Local thumbnails of book covers.
+
+Covers are fetched from their remote hosts once, scaled down to the widths
+of COVER_SIZES (when Pillow is installed, otherwise served as they are) and
+kept in COVER_CACHE_PATH, where the least recently used files are removed
+once they take more than COVER_CACHE_MAX_BYTES. Templates refer to covers
+through cover_url(book, size); these URLs change along with Book.cover_url,
+so browsers may cache them forever.
+"""
+
+import hashlib
+import io
+import ipaddress
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+from urllib.parse import urljoin, urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool
+from requests.packages.urllib3.connectionpool import HTTPSConnectionPool
+from requests.packages.urllib3.exceptions import ConnectTimeoutError
+from requests.packages.urllib3.exceptions import NewConnectionError
+from requests.packages.urllib3.util.connection import create_connection
+from flask import Blueprint, current_app, request, redirect
+from flask import url_for, abort
+from database import session
+from database_setup import Book
+import singleflight
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+CACHE_MAX_AGE = 365 * 24 * 60 * 60
+CACHE_CONTROL = 'public, max-age={}, immutable'.format(CACHE_MAX_AGE)
+# URLs without current cover version are cached for a short time only
+UNVERSIONED_CACHE_CONTROL = 'public, max-age=3600'
+VERSION_LENGTH = 12
+
+# Image types served, by their first bytes. SVG is never served, it may
+# carry scripts
+SIGNATURES = ((b'\xff\xd8\xff', 'image/jpeg'),
+              (b'\x89PNG\r\n\x1a\n', 'image/png'),
+              (b'GIF87a', 'image/gif'),
+              (b'GIF89a', 'image/gif'))
+JPEG_QUALITY = 85
+
+source_fetches = singleflight.group('cover_source')
+thumbnail_builds = singleflight.group('cover_thumbnail')
+
+
+def detect_mimetype(content):
+    """Returns mimetype of image by its first bytes, or None"""
+    for signature, mimetype in SIGNATURES:
+        if content.startswith(signature):
+            return mimetype
+    if content[:4] == b'RIFF' and content[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+def cover_key(cover_url):
+    return hashlib.sha256(cover_url.encode('utf-8')).hexdigest()[:32]
+
+
+class CoverCache(object):
+    """Files in a directory, the least recently used of which are removed
+    when all of them take more than max_bytes. Use is tracked by file
+    modification times, so processes on the host share the cache"""
+
+    # Modification times of used files are updated at most this often
+    TOUCH_INTERVAL = 60
+    TEMP_PREFIX = '.tmp'
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def read(self, name):
+        """Returns content of cached file, or None"""
+        path = self.path(name)
+        try:
+            with open(path, 'rb') as cached_file:
+                content = cached_file.read()
+            if time.time() - os.stat(path).st_mtime > self.TOUCH_INTERVAL:
+                os.utime(path)
+        except FileNotFoundError:
+            return None
+        return content
+
+    def set(self, name, content):
+        """Stores file atomically"""
+        fd, temp_path = tempfile.mkstemp(dir=self.directory,
+                                         prefix=self.TEMP_PREFIX)
+        try:
+            with os.fdopen(fd, 'wb') as cached_file:
+                cached_file.write(content)
+            os.replace(temp_path, self.path(name))
+        except OSError:
+            os.unlink(temp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            files = []
+            total = 0
+            for entry in os.scandir(self.directory):
+                if entry.name.startswith(self.TEMP_PREFIX):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+            files.sort()
+            for _, size, path in files:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+
+class FailedFetches(object):
+    """Covers which could not be fetched lately; these are not fetched
+    again for retry_interval seconds"""
+
+    MAX_ENTRIES = 1000
+
+    def __init__(self, retry_interval):
+        self.retry_interval = retry_interval
+        self.lock = threading.Lock()
+        self.failed_at = {}
+
+    def is_failed(self, cover_url):
+        with self.lock:
+            failed_at = self.failed_at.get(cover_url)
+            return failed_at is not None and \
+                time.time() - failed_at < self.retry_interval
+
+    def add(self, cover_url):
+        with self.lock:
+            if len(self.failed_at) >= self.MAX_ENTRIES:
+                self.failed_at.clear()
+            self.failed_at[cover_url] = time.time()
+
+
+def resolve_public(host, port):
+    """Returns address to connect to host at. Raises ValueError unless all
+    addresses of host are public, so users cannot make the server call
+    internal ones"""
+    try:
+        addresses = socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError) as e:
+        raise ValueError("Cannot resolve {}: {}".format(host, e))
+    for address in addresses:
+        ip = ipaddress.ip_address(address[4][0].split('%')[0])
+        if not ip.is_global or ip.is_multicast:
+            raise ValueError("Cover host {} is not public".format(host))
+    return addresses[0][4][0]
+
+
+class PublicAddressConnection(object):
+    """Connects to the address of host checked by resolve_public(), so
+    host cannot resolve to another (internal) one for the request itself.
+    Host header, SNI and certificate checks still use the host name"""
+
+    def _new_conn(self):
+        address = resolve_public(self.host.strip('[]'), self.port)
+        try:
+            return create_connection((address, self.port), self.timeout,
+                                     socket_options=self.socket_options)
+        except socket.timeout:
+            raise ConnectTimeoutError(self, "Connection to {} timed out"
+                                      .format(self.host))
+        except OSError as e:
+            raise NewConnectionError(self, "Cannot connect to {}: {}"
+                                     .format(self.host, e))
+
+
+class PublicHTTPConnection(PublicAddressConnection,
+                           HTTPConnectionPool.ConnectionCls):
+    pass
+
+
+class PublicHTTPSConnection(PublicAddressConnection,
+                            HTTPSConnectionPool.ConnectionCls):
+    pass
+
+
+class PublicHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = PublicHTTPConnection
+
+
+class PublicHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = PublicHTTPSConnection
+
+
+class PublicHostAdapter(HTTPAdapter):
+    """Transport adapter connecting to public addresses only"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': PublicHTTPConnectionPool,
+            'https': PublicHTTPSConnectionPool}
+
+
+def make_http_session(allow_private_hosts):
+    """Returns session fetching covers. Proxies of environment are not
+    used, as they would connect to hosts on our behalf"""
+    http = requests.Session()
+    http.trust_env = False
+    if not allow_private_hosts:
+        adapter = PublicHostAdapter()
+        http.mount('http://', adapter)
+        http.mount('https://', adapter)
+    return http
+
+
+def check_http_url(url):
+    """Raises ValueError unless URL is http(s) one"""
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValueError("Not an HTTP URL: {}".format(url))
+
+
+def open_source(cover_url):
+    """Returns streamed response of cover URL, following redirects to
+    public hosts only"""
+    config = current_app.config
+    http = current_app.extensions['cover_http']
+    url = cover_url
+    for _ in range(config['COVER_MAX_REDIRECTS'] + 1):
+        check_http_url(url)
+        response = http.get(url, stream=True, allow_redirects=False,
+                            timeout=(config['COVER_CONNECT_TIMEOUT'],
+                                     config['COVER_READ_TIMEOUT']))
+        if not response.is_redirect:
+            return response
+        response.close()
+        url = urljoin(url, response.headers['Location'])
+    raise ValueError("Too many redirects of {}".format(cover_url))
+
+
+def fetch_source(cover_url):
+    """Returns content of remote cover image. Raises ValueError if it is
+    not an image, is too large or is not on a public host"""
+    max_bytes = current_app.config['COVER_MAX_SOURCE_BYTES']
+    response = open_source(cover_url)
+    with response:
+        response.raise_for_status()
+        content = bytearray()
+        for chunk in response.iter_content(1 << 16):
+            content += chunk
+            if len(content) > max_bytes:
+                raise ValueError("Cover is larger than {} bytes".format(
+                    max_bytes))
+    content = bytes(content)
+    if detect_mimetype(content) is None:
+        raise ValueError("Cover is not a JPEG, PNG, GIF or WebP image")
+    return content
+
+
+def make_thumbnail(content, width):
+    """Returns image scaled down to width, as JPEG (or PNG, if it has
+    transparency). Images which cannot be scaled are returned as they
+    are"""
+    if Image is None:
+        return content
+    try:
+        image = Image.open(io.BytesIO(content))
+        if image.width <= width:
+            return content
+        image.thumbnail((width, image.height))
+        output = io.BytesIO()
+        if image.mode in ('RGBA', 'LA') or 'transparency' in image.info:
+            image.save(output, 'PNG', optimize=True)
+        else:
+            image.convert('RGB').save(output, 'JPEG', quality=JPEG_QUALITY,
+                                      optimize=True, progressive=True)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        logging.warning("Cannot scale cover image: {}".format(e))
+        return content
+    return output.getvalue()
+
+
+def get_source(cache, cover_url):
+    name = cover_key(cover_url)
+    content = cache.read(name)
+    if content is None:
+        content = source_fetches.do(cover_url, lambda: fetch_source(
+            cover_url))
+        store(cache, name, content)
+    return content
+
+
+def store(cache, name, content):
+    """Caches file, if possible; fetched covers are served anyway"""
+    try:
+        cache.set(name, content)
+    except OSError as e:
+        logging.warning("Cannot cache cover {}: {}".format(name, e))
+
+
+def get_thumbnail(cover_url, width):
+    """Returns (name, content) of cover thumbnail, fetching and scaling
+    it if it is not cached"""
+    cache = current_app.extensions['cover_cache']
+    name = '{}-{}'.format(cover_key(cover_url), width)
+    content = cache.read(name)
+    if content is not None:
+        return name, content
+
+    def build():
+        content = make_thumbnail(get_source(cache, cover_url), width)
+        store(cache, name, content)
+        return content
+    return name, thumbnail_builds.do(name, build)
+
+
+def cover_url(book, size):
+    """Returns URL of book cover thumbnail of given width"""
+    if not book.cover_url:
+        return None
+    return url_for('covers.show_cover', book_id=book.id, size=size,
+                   v=cover_key(book.cover_url)[:VERSION_LENGTH])
+
+
+covers = Blueprint('covers', __name__)
+
+
+@covers.route('/cover/<int:book_id>/<int:size>')
+def show_cover(book_id, size):
+    if size not in current_app.config['COVER_SIZES']:
+        return abort(404)
+    source_url = session.query(Book.cover_url).filter_by(id=book_id).scalar()
+    if not source_url or not source_url.startswith(('http://', 'https://')):
+        return abort(404)
+
+    failed = current_app.extensions['cover_failures']
+    thumbnail = None
+    if not failed.is_failed(source_url):
+        try:
+            thumbnail = get_thumbnail(source_url, size)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logging.warning("Cannot fetch cover of book {}: {}".format(
+                book_id, e))
+            failed.add(source_url)
+    if thumbnail is None:
+        # Let browser try the original image
+        response = redirect(source_url)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    name, content = thumbnail
+    response = current_app.response_class(
+        content, mimetype=detect_mimetype(content))
+    response.set_etag(name)
+    response.make_conditional(request)
+    if request.args.get('v') == cover_key(source_url)[:VERSION_LENGTH]:
+        response.headers['Cache-Control'] = CACHE_CONTROL
+    else:
+        response.headers['Cache-Control'] = UNVERSIONED_CACHE_CONTROL
+    return response
+
+
+def init_app(app):
+    app.extensions['cover_cache'] = CoverCache(
+        app.config['COVER_CACHE_PATH'], app.config['COVER_CACHE_MAX_BYTES'])
+    app.extensions['cover_failures'] = FailedFetches(
+        app.config['COVER_RETRY_INTERVAL'])
+    app.extensions['cover_http'] = make_http_session(
+        app.config['COVER_ALLOW_PRIVATE_HOSTS'])
+    app.jinja_env.globals['cover_url'] = cover_url
+    app.register_blueprint(covers)
@@ -0,0 +1,177 @@
+import os
+import random
+import threading
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import create_engine, event, exc, select
+from sqlalchemy.sql.expression import Delete, Insert, Update
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import Session, scoped_session, sessionmaker
+
+
+PRIMARY = 'primary'
+# Set for clients which have just changed data
+PRIMARY_COOKIE = 'use_primary'
+
+_settings = {}
+_database_paths = {}
+_engines = {}
+# Engines inherited from parent process, see get_engine()
+_inherited_engines = []
+_engines_pid = None
+_engine_lock = threading.Lock()
+
+
+def ping_connection(connection, branch):
+    """Checks pooled connection is alive before handing it out.
+    Stale connection is invalidated and transparently reconnected"""
+    if branch:
+        return
+    should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        connection.scalar(select([1]))
+    except exc.DBAPIError as e:
+        if not e.connection_invalidated:
+            raise
+        connection.scalar(select([1]))
+    finally:
+        connection.should_close_with_result = should_close_with_result
+
+
+def remember_connection_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+def check_connection_pid(dbapi_connection, connection_record,
+                         connection_proxy):
+    """Refuses to use connection opened by another (parent) process"""
+    pid = os.getpid()
+    if connection_record.info['pid'] != pid:
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            "Connection record belongs to pid {}, "
+            "attempting to check out in pid {}".format(
+                connection_record.info['pid'], pid))
+
+
+def make_engine(database_path, pool_size, max_overflow, pool_timeout,
+                pool_recycle, pool_pre_ping):
+    options = {'pool_recycle': pool_recycle}
+    # SQLite uses its own pools which do not accept sizing arguments
+    if make_url(database_path).get_backend_name() != 'sqlite':
+        options.update(pool_size=pool_size,
+                       max_overflow=max_overflow,
+                       pool_timeout=pool_timeout)
+    engine = create_engine(database_path, **options)
+    if pool_pre_ping:
+        event.listen(engine, 'engine_connect', ping_connection)
+    event.listen(engine.pool, 'connect', remember_connection_pid)
+    event.listen(engine.pool, 'checkout', check_connection_pid)
+    return engine
+
+
+def get_engine(name=PRIMARY):
+    """Returns engine of given database (primary or one of replicas) in
+    current process, creating it on first use. Engines inherited from
+    parent process after fork are replaced, so worker processes never
+    share database sockets"""
+    global _engines_pid
+    pid = os.getpid()
+    if _engines_pid == pid and name in _engines:
+        return _engines[name]
+    with _engine_lock:
+        if _engines_pid != pid:
+            abandon_engines()
+            _engines_pid = pid
+        if name not in _engines:
+            _engines[name] = make_engine(_database_paths[name], **_settings)
+    return _engines[name]
+
+
+def abandon_engines():
+    """Drops engines of parent process without closing their connections:
+    closing (or garbage collecting) them would close sockets the parent
+    still uses. They are kept referenced and never used again"""
+    _inherited_engines.extend(_engines.values())
+    _engines.clear()
+
+
+def dispose_engines():
+    for engine in _engines.values():
+        engine.dispose()
+    _engines.clear()
+
+
+def get_replica_names():
+    return [name for name in _database_paths if name != PRIMARY]
+
+
+def primary(f):
+    """Makes view use primary database only, e.g. for reading data
+    it is going to change"""
+    f.use_primary = True
+    return f
+
+
+def pin_primary():
+    """Makes following requests of the client read from primary database
+    for a while, so they see changes made by current request even if
+    replicas lag behind"""
+    g.pin_primary = True
+
+
+def should_use_primary():
+    if not has_request_context() or not get_replica_names():
+        return True
+    if g.get('pin_primary') or request.method not in ('GET', 'HEAD'):
+        return True
+    if request.cookies.get(PRIMARY_COOKIE):
+        return True
+    view = current_app.view_functions.get(request.endpoint)
+    return getattr(view, 'use_primary', False)
+
+
+class CatalogSession(Session):
+    """Session reading from a replica, chosen once per session, in
+    requests which do not change data; everything else goes to primary"""
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, (Insert, Update, Delete)) \
+                or should_use_primary():
+            return get_engine(PRIMARY)
+        if 'replica' not in self.info:
+            self.info['replica'] = random.choice(get_replica_names())
+        return get_engine(self.info['replica'])
+
+
+# Every thread gets its own session; it is removed at the end of request
+session = scoped_session(sessionmaker(class_=CatalogSession))
+
+
+def remove_session(exception=None):
+    session.remove()
+
+
+def set_primary_cookie(response):
+    if g.get('pin_primary'):
+        response.set_cookie(PRIMARY_COOKIE, '1', httponly=True,
+                            max_age=current_app.config['DB_PRIMARY_PIN'])
+    return response
+
+
+def init_app(app):
+    """Remembers database settings of the app. No connections are made
+    until the first query, so app can be preloaded before forking"""
+    _settings.update(pool_size=app.config['DB_POOL_SIZE'],
+                     max_overflow=app.config['DB_MAX_OVERFLOW'],
+                     pool_timeout=app.config['DB_POOL_TIMEOUT'],
+                     pool_recycle=app.config['DB_POOL_RECYCLE'],
+                     pool_pre_ping=app.config['DB_POOL_PRE_PING'])
+    with _engine_lock:
+        dispose_engines()
+        _database_paths.clear()
+        _database_paths[PRIMARY] = app.config['DATABASE_PATH']
+        for number, path in enumerate(app.config['DATABASE_REPLICA_PATHS']):
+            _database_paths['replica-{}'.format(number)] = path
+    app.teardown_appcontext(remove_session)
+    app.after_request(set_primary_cookie)
@@ -1,7 +1,8 @@
-from sqlalchemy import Column, ForeignKey, Integer, String
+import datetime
+from sqlalchemy import Column, ForeignKey, Integer, String, DateTime, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, DDL
 from common import DATABASE_PATH
 
 
@@ -10,6 +11,7 @@ Base = declarative_base()
 
 class Genre(Base):
     __tablename__ = 'genre'
+    __table_args__ = (Index('ix_genre_name', 'name', unique=True),)
 
     id = Column(Integer, primary_key=True)
     name = Column(String(80), nullable=False)
@@ -24,6 +26,8 @@ class Genre(Base):
 
 class User(Base):
     __tablename__ = 'user'
+    __table_args__ = (Index('ix_user_provider', 'provider', 'provider_id',
+                            unique=True),)
 
     id = Column(Integer, primary_key=True)
     name = Column(String(80), nullable=False)
@@ -33,8 +37,15 @@ class User(Base):
     provider_id = Column(String(250), nullable=False)
 
 
+def build_book_url(book_id, title):
+    return "{}-{}".format(book_id, title.replace(' ', '-'))
+
+
 class Book(Base):
     __tablename__ = 'book'
+    __table_args__ = (Index('ix_book_genre_id', 'genre_id', 'id'),
+                      Index('ix_book_user_id', 'user_id'),
+                      Index('ix_book_created_at', 'created_at', 'id'))
 
     id = Column(Integer, primary_key=True)
     title = Column(String(80), nullable=False)
@@ -49,9 +60,11 @@ class Book(Base):
     genre = relationship(Genre)
     user_id = Column(Integer, ForeignKey('user.id'))
     user = relationship(User)
+    created_at = Column(DateTime, nullable=False,
+                        default=datetime.datetime.utcnow)
 
     def build_url(self):
-        return "{}-{}".format(self.id, self.title.replace(' ', '-'))
+        return build_book_url(self.id, self.title)
 
     @property
     def serialize(self):
@@ -67,6 +80,58 @@ class Book(Base):
                 'user': self.user.name}
 
 
+# Text searched by /search; queries must use the very same expression for
+# PostgreSQL to pick the full-text index. Queries qualify the columns, as
+# they may join other tables with columns of the same names
+BOOK_SEARCH_TEMPLATE = ("to_tsvector('english', "
+                        "coalesce({0}title, '') || ' ' || "
+                        "coalesce({0}author, '') || ' ' || "
+                        "coalesce({0}description, ''))")
+BOOK_SEARCH_DOCUMENT = BOOK_SEARCH_TEMPLATE.format('')
+BOOK_SEARCH_QUERY_DOCUMENT = BOOK_SEARCH_TEMPLATE.format('book.')
+
+BOOK_SEARCH_INDEX = DDL(
+    "CREATE INDEX IF NOT EXISTS ix_book_search ON book "
+    "USING gin ({})".format(BOOK_SEARCH_DOCUMENT)).execute_if(
+        dialect='postgresql')
+
+event.listen(Book.__table__, 'after_create', BOOK_SEARCH_INDEX)
+
+
+class CatalogVersion(Base):
+    """Version of a group of catalog pages, incremented on every change
+    of books shown on these pages"""
+    __tablename__ = 'catalog_version'
+
+    name = Column(String(250), primary_key=True)
+    version = Column(Integer, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
+
+
+class CatalogStat(Base):
+    """Number of books of the whole catalog (kind 'total'), of a genre,
+    year or user (key is genre id, year or user id). Maintained along with
+    book changes, see stats.py"""
+    __tablename__ = 'catalog_stat'
+
+    kind = Column(String(16), primary_key=True)
+    key = Column(String(80), primary_key=True)
+    books = Column(Integer, nullable=False)
+    # Highest book id, kept for the whole catalog and genres only
+    latest_book_id = Column(Integer)
+
+
+class BookChange(Base):
+    """Entry of append-only log of book changes, see changes.py"""
+    __tablename__ = 'book_change'
+
+    seq = Column(Integer, primary_key=True)
+    # Not a foreign key, entries of deleted books stay in the log
+    book_id = Column(Integer, nullable=False)
+    action = Column(String(8), nullable=False)
+    changed_at = Column(DateTime, nullable=False)
+
+
 def main():
     # will create a new database
     engine = create_engine(DATABASE_PATH)
@@ -75,6 +140,10 @@ def main():
     Base.metadata.drop_all(engine)
     Base.metadata.create_all(engine)
 
+    # fresh schema is up to date, no migrations needed
+    import migrations
+    migrations.stamp(engine)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""Bulk catalog importer.
+
+Reads books from JSON file ({"books": [...]}, as in data/) or NDJSON file
+(as produced by /catalog/export) without loading it into memory, and inserts
+them in large batches:
+
+    python3 importer.py data/database_initial_books.json \\
+        --genres data/database_initial_genres.json --commit-size 50000
+"""
+
+import argparse
+import csv
+import datetime
+import io
+import json
+import logging
+import re
+import time
+from sqlalchemy import create_engine, func, select
+from sqlalchemy.orm import sessionmaker
+from common import DATABASE_PATH
+from database_setup import Genre, Book, User
+import changes
+import stats
+import versions
+
+
+BOOK_FIELDS = ('title', 'cover_url', 'cover_url_attribution', 'description',
+               'author', 'year', 'buy_url')
+BOOK_COLUMNS = BOOK_FIELDS + ('genre_id', 'user_id', 'created_at')
+CHUNK_SIZE = 1 << 16
+WHITESPACE_AND_COMMAS = ' \t\r\n,'
+
+
+def iter_json_array(stream, root):
+    """Yields items of array stored under root key of JSON document,
+    reading stream by chunks"""
+    decoder = json.JSONDecoder()
+    array_start = re.compile(r'"{}"\s*:\s*\['.format(re.escape(root)))
+    buffer = ''
+    match = None
+    while match is None:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            raise ValueError("No '{}' array found".format(root))
+        buffer += chunk
+        match = array_start.search(buffer)
+
+    position = match.end()
+    while True:
+        while position < len(buffer) and \
+                buffer[position] in WHITESPACE_AND_COMMAS:
+            position += 1
+        if position < len(buffer) and buffer[position] == ']':
+            return
+        try:
+            if position == len(buffer):
+                raise ValueError("Need more data")
+            item, position = decoder.raw_decode(buffer, position)
+        except ValueError:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                raise ValueError("Unterminated '{}' array".format(root))
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        yield item
+
+
+def iter_ndjson(stream):
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def iter_books_data(filename):
+    with open(filename) as books_file:
+        if filename.endswith(('.ndjson', '.jsonl')):
+            yield from iter_ndjson(books_file)
+        else:
+            yield from iter_json_array(books_file, 'books')
+
+
+def load_genre_ids(session):
+    return dict(session.query(Genre.name, Genre.id))
+
+
+def ensure_genres(session, filename):
+    """Adds genres from file which are missing in the database"""
+    genre_ids = load_genre_ids(session)
+    added = False
+    with open(filename) as genres_file:
+        for genre_data in iter_json_array(genres_file, 'genres'):
+            if genre_data.get('name') in genre_ids:
+                continue
+            try:
+                session.add(Genre(**genre_data))
+                added = True
+            except TypeError:
+                logging.warning("Malformed genre data: {}".format(genre_data))
+    if added:
+        versions.bump(session, [versions.GENRES])
+    session.commit()
+
+
+def get_importer(session):
+    importer = session.query(User).filter_by(provider='local',
+                                             provider_id='000').first()
+    if importer is None:
+        importer = User(name="Importer",
+                        email="nobody@example.com",
+                        picture="https://www.gravatar.com/avatar/"
+                                "00000000000000000000000000000000",
+                        provider="local",
+                        provider_id="000")
+        session.add(importer)
+        session.commit()
+    return importer
+
+
+def make_book_row(book_data, genre_ids, user_id):
+    """Returns dict of book table values, or None for malformed data"""
+    genre_id = genre_ids.get(book_data.get('genre'))
+    if genre_id is None:
+        logging.warning("No genre for book {}".format(book_data))
+        return None
+    if not book_data.get('title'):
+        logging.warning("Malformed book data: {}".format(book_data))
+        return None
+    row = {field: book_data.get(field) for field in BOOK_FIELDS}
+    row['genre_id'] = genre_id
+    row['user_id'] = user_id
+    row['created_at'] = datetime.datetime.utcnow()
+    return row
+
+
+def reserve_book_ids(connection, rows):
+    """Gives rows ids from PostgreSQL sequence of book ids, so inserted
+    books are known without reading them back"""
+    if connection.dialect.name != 'postgresql':
+        return
+    book_ids = [book_id for book_id, in connection.execute(
+        "SELECT nextval(pg_get_serial_sequence('book', 'id')) "
+        "FROM generate_series(1, %s)", (len(rows),))]
+    for row, book_id in zip(rows, book_ids):
+        row['id'] = book_id
+
+
+def get_inserted_ids(connection, rows):
+    """Returns ids of just inserted rows. Without ids reserved in advance,
+    the rows got consecutive ids after the highest one: SQLite transaction
+    holds the write lock of the whole database since its first insert"""
+    if rows and 'id' in rows[0]:
+        return [row['id'] for row in rows]
+    last_id = connection.scalar(select([func.max(Book.__table__.c.id)]))
+    book_ids = list(range(last_id - len(rows) + 1, last_id + 1))
+    for row, book_id in zip(rows, book_ids):
+        row['id'] = book_id
+    return book_ids
+
+
+def insert_executemany(connection, rows):
+    connection.execute(Book.__table__.insert(), rows)
+
+
+def insert_copy(connection, rows):
+    """Inserts rows with PostgreSQL COPY, which is much faster than
+    INSERT statements for large batches"""
+    columns = BOOK_COLUMNS + (('id',) if 'id' in rows[0] else ())
+    data = io.StringIO()
+    writer = csv.writer(data)
+    for row in rows:
+        writer.writerow(['\\N' if row[column] is None else row[column]
+                         for column in columns])
+    data.seek(0)
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(
+        "COPY book ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(
+            ', '.join(columns)), data)
+
+
+def import_books(engine, filename, user_id, batch_size=1000,
+                 commit_size=10000, method=None):
+    """Inserts books from file, committing every commit_size books.
+    Returns number of imported books and ids of genres they belong to"""
+    if method is None:
+        method = 'copy' if engine.dialect.name == 'postgresql' \
+            else 'executemany'
+    insert = {'copy': insert_copy, 'executemany': insert_executemany}[method]
+
+    session = sessionmaker(bind=engine)()
+    genre_ids = load_genre_ids(session)
+    session.close()
+
+    imported = 0
+    genres = set()
+    started = time.time()
+    connection = engine.connect()
+    transaction = connection.begin()
+    pending = 0
+    batch = []
+
+    def insert_batch():
+        reserve_book_ids(connection, batch)
+        insert(connection, batch)
+        book_ids = get_inserted_ids(connection, batch)
+        # Counters are locked before the change log, as ORM flushes do
+        stats.add_book_rows(connection, batch)
+        changes.log_books_created(connection, book_ids)
+        genres.update(row['genre_id'] for row in batch)
+        inserted = len(batch)
+        del batch[:]
+        return inserted
+
+    try:
+        for book_data in iter_books_data(filename):
+            row = make_book_row(book_data, genre_ids, user_id)
+            if row is None:
+                continue
+            batch.append(row)
+            if len(batch) >= batch_size:
+                pending += insert_batch()
+            if pending >= commit_size:
+                transaction.commit()
+                imported += pending
+                pending = 0
+                report_progress(imported, started)
+                transaction = connection.begin()
+        if batch:
+            pending += insert_batch()
+        transaction.commit()
+        imported += pending
+    except Exception:
+        transaction.rollback()
+        raise
+    finally:
+        connection.close()
+
+    report_progress(imported, started)
+    return imported, genres
+
+
+def report_progress(imported, started):
+    elapsed = max(time.time() - started, 1e-6)
+    logging.info("Imported {} books ({:.0f} rows/sec)".format(
+        imported, imported / elapsed))
+
+
+def bump_versions(session, genre_ids):
+    """Marks pages showing imported books as changed"""
+    names = dict(session.query(Genre.id, Genre.name))
+    scopes = [versions.HOMEPAGE]
+    scopes.extend(versions.genre_scope(names[genre_id])
+                  for genre_id in genre_ids)
+    versions.bump(session, scopes)
+    session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk import books")
+    parser.add_argument('books', help="JSON or NDJSON file with books")
+    parser.add_argument('--genres', help="JSON file with genres to create")
+    parser.add_argument('--database', default=DATABASE_PATH)
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help="books inserted by one statement")
+    parser.add_argument('--commit-size', type=int, default=10000,
+                        help="books inserted by one transaction")
+    parser.add_argument('--method', choices=['copy', 'executemany'],
+                        help="insert method (copy for PostgreSQL "
+                             "by default)")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    engine = create_engine(args.database)
+    session = sessionmaker(bind=engine)()
+    if args.genres:
+        ensure_genres(session, args.genres)
+    importer = get_importer(session)
+
+    imported, genre_ids = import_books(engine, args.books, importer.id,
+                                       args.batch_size, args.commit_size,
+                                       args.method)
+    if imported:
+        bump_versions(session, genre_ids)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,7 @@ git clone "$PROJECT_REPO" "$PROJECT_DIR"
 virtualenv venv
 . "$PROJECT_DIR/venv/bin/activate"
 pip3 install -r requirements.txt
-python3 database_setup.py
+python3 migrations.py
+python3 assets.py
 python3 database_populate.py
 deactivate
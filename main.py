@@ -8,48 +8,153 @@ import re
 import hashlib
 from functools import wraps
 from urllib.parse import urlencode
-from flask import Flask, render_template, request, redirect, url_for, abort
-from flask import jsonify, flash, make_response
+from flask import Flask, Blueprint, render_template, request, redirect
+from flask import url_for, abort
+from flask import jsonify, flash, make_response, current_app
+from flask import Response, stream_with_context
 from flask import session as login_session
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from common import DATABASE_PATH
-from database_setup import Base, Genre, Book, User
-from secrets import FLASH_SECRET
-from oauth import OAUTH_PROVIDER_DATA
+from sqlalchemy.orm import joinedload
+from database import session
+from database_setup import Book, User, build_book_url
+import assets
+import autocomplete
+import changes
+import covers
+import database
+import metrics
+import oauth_client
+import query_budget
+import response_cache
+import registry
+import search
+import serializers
+import session_store
+import singleflight
+import stats
+import template_cache
+import versions
 import requests
 from requests.auth import HTTPBasicAuth
 
 USERAGENT = "udacity-book-catalog 0.1"
 BOOK_TITLE_RE = re.compile(r'^[\w\d,;. ]*$', re.UNICODE)
-
-app = Flask(__name__)
-app.secret_key = FLASH_SECRET
-
-engine = create_engine(DATABASE_PATH)
-Base.metadata.bind = engine
-
-DBSession = sessionmaker(bind=engine)
-session = DBSession()
+# Book changes also update versions of every page showing the book
+WRITE_QUERY_BUDGET = 30
+BOOK_FIELDS = ('title', 'cover_url', 'cover_url_attribution', 'description',
+               'genre', 'year', 'buy_url')
+BOOK_FORM_FIELDS = {'title': 'book-title',
+                    'cover_url': 'book-image-url',
+                    'cover_url_attribution': 'book-image-url-attribution',
+                    'description': 'book-description',
+                    'genre': 'book-genre',
+                    'year': 'book-year',
+                    'buy_url': 'book-buy-url'}
+
+catalog = Blueprint('catalog', __name__)
+
+# Concurrent identical reads of a process share one query
+book_loads = singleflight.group('book')
+genre_page_loads = singleflight.group('genre_page')
+recent_books_loads = singleflight.group('recent_books')
+
+
+def get_genre(genre_name):
+    genre = registry.genres.get(genre_name)
+    if genre is None:
+        logging.warning("Missing genre requested: {}".format(genre_name))
+    return genre
 
 
 def get_genre_id(genre_name):
     if genre_name is None:
         return None
-    genre = session.query(Genre).filter_by(name=genre_name)
-    if genre.count() == 0:
-        logging.warning("Missing genre requested: {}".format(genre_name))
-        return None
-    return genre.one().id
+    genre = get_genre(genre_name)
+    return genre.id if genre is not None else None
 
 
-def get_book_by_title(book_title):
-    book_id = book_title.split('-', maxsplit=1)[0]
-    book = session.query(Book).filter_by(id=book_id)
-    if book.count() == 0:
+def get_book_by_title(book_title, use_cache=False):
+    """Returns book by URL part (id followed by title), or None.
+    Read-only views may use process-wide cache of books"""
+    try:
+        book_id = int(book_title.split('-', maxsplit=1)[0])
+    except ValueError:
+        book_id = None
+    book = registry.books.get(book_id) if use_cache else None
+    if book is not None:
+        return book
+    if book_id is not None and use_cache:
+        books = share_books(book_loads, book_id,
+                            query_books().filter_by(id=book_id).limit(1).all)
+        book = books[0] if books else None
+    elif book_id is not None:
+        book = query_books().filter_by(id=book_id).first()
+    if book is None:
         logging.warning("Missing book URL requested: {}".format(book_title))
         return None
-    return book.one()
+    if use_cache:
+        registry.books.set(book)
+    return book
+
+
+def query_books():
+    """Returns books query which loads genre and user along with each book"""
+    return session.query(Book).options(joinedload(Book.genre),
+                                       joinedload(Book.user))
+
+
+def share_books(group, key, load):
+    """Returns result of load(), a list of books or book rows, running it
+    once for concurrent calls with the same key. Books are detached from
+    session of the thread which loaded them and merged into session of
+    every caller without querying the database"""
+    def load_detached():
+        books = load()
+        for book in books:
+            if isinstance(book, Book):
+                session.expunge(book)
+        return books
+
+    # Requests pinned to primary database must not get replica results
+    books = group.do((key, database.should_use_primary()), load_detached)
+    return [session.merge(book, load=False) if isinstance(book, Book)
+            else book for book in books]
+
+
+def homepage_scope():
+    return versions.HOMEPAGE
+
+
+def genre_page_scope(genre):
+    return versions.genre_scope(genre)
+
+
+def book_page_scope(book_title):
+    return versions.book_scope(book_title.split('-', maxsplit=1)[0])
+
+
+def book_scopes(book):
+    """Returns scopes of all pages showing given book"""
+    return [versions.HOMEPAGE,
+            versions.genre_scope(book.genre.name),
+            versions.book_scope(book.id)]
+
+
+def commit_book_changes(scopes, book_ids):
+    """Commits pending changes of given books shown in given page scopes.
+    Scope versions are incremented in the same transaction, and cached
+    pages of the scopes and cached books are dropped"""
+    versions.bump(session, scopes)
+    session.commit()
+    database.pin_primary()
+    response_cache.invalidate(*scopes)
+    registry.books.invalidate(book_ids)
+    autocomplete.index.update()
+
+
+def query_recent_books(query, limit=10):
+    """Returns books (or book rows) of query added last"""
+    return query.order_by(Book.created_at.desc(),
+                          Book.id.desc()).limit(limit).all()
 
 
 def login_required(f):
@@ -59,83 +164,396 @@ def login_required(f):
             return f(*args, **kwargs)
         else:
             flash("Please login to perform this action", 'error')
-            return redirect(url_for('show_login'))
+            return redirect(url_for('.show_login'))
     return decorated_function
 
 
-@app.route('/')
+@catalog.route('/')
+@response_cache.cached(homepage_scope)
 def show_homepage():
-    genres = session.query(Genre).all()
-    recent_books = session.query(Book).limit(10)
+    # Versions of cached fragments are read before their data
+    genres_version = versions.get_request_version(versions.GENRES)
+    homepage_version = versions.get_request_version(versions.HOMEPAGE)
+    genres = registry.genres.all()
+    recent_books = share_books(recent_books_loads, 'books',
+                               lambda: query_recent_books(query_books()))
+    genre_counts = stats.get_counts(session, stats.GENRE)
+    total_books, _ = stats.get_count(session, stats.TOTAL)
     return render_template('homepage.html',
                            genres=genres, recent_books=recent_books,
+                           genre_counts=genre_counts,
+                           total_books=total_books,
+                           genres_version=genres_version,
+                           homepage_version=homepage_version,
                            login_session=login_session)
 
 
-@app.route('/json')
+@catalog.route('/json')
+@response_cache.cached(homepage_scope, per_user=False)
+@versions.conditional(homepage_scope)
 def show_homepage_json():
-    genres = session.query(Genre).all()
-    recent_books = session.query(Book).limit(10)
-    return jsonify(genres=[genre.serialize for genre in genres],
-                   recent_books=[book.serialize for book in recent_books])
+    genres = registry.genres.all()
+    recent_books = share_books(
+        recent_books_loads, 'rows',
+        lambda: query_recent_books(serializers.query_book_rows()))
+    return serializers.json_response(
+        genres=[genre.serialize for genre in genres],
+        recent_books=serializers.serialize_rows(recent_books))
+
+
+def serialize_latest_books(book_ids):
+    """Returns {id: {id, title, url}} of given books"""
+    book_ids = [book_id for book_id in book_ids if book_id is not None]
+    if not book_ids:
+        return {}
+    return {book.id: {'id': book.id, 'title': book.title,
+                      'url': url_for('.show_book', book_title=build_book_url(
+                          book.id, book.title))}
+            for book in session.query(Book.id, Book.title).filter(
+                Book.id.in_(book_ids))}
+
+
+@catalog.route('/stats/json')
+@response_cache.cached(homepage_scope, per_user=False)
+@versions.conditional(homepage_scope)
+def show_stats_json():
+    """Returns numbers of books in the catalog, per genre, per year and
+    per user, and latest added books of the catalog and of every genre"""
+    counts = stats.get_all_counts(session)
+    total_books, latest_book_id = counts[stats.TOTAL].get('', (0, None))
+    genre_counts = counts[stats.GENRE]
+    year_counts = counts[stats.YEAR]
+    user_counts = counts[stats.USER]
+    latest_books = serialize_latest_books(
+        [latest_book_id] + [latest for _, latest in genre_counts.values()])
+    users = []
+    if user_counts:
+        users = session.query(User.id, User.name).filter(
+            User.id.in_([int(key) for key in user_counts])).all()
+
+    genres = []
+    for genre in registry.genres.all():
+        books, latest = genre_counts.get(str(genre.id), (0, None))
+        genres.append({'name': genre.name, 'books': books,
+                       'latest_book': latest_books.get(latest)})
+    return serializers.json_response(
+        books=total_books,
+        latest_book=latest_books.get(latest_book_id),
+        genres=genres,
+        years=[{'year': int(key) if key else None, 'books': books}
+               for key, (books, _) in sorted(year_counts.items())
+               if books],
+        users=[{'id': user.id, 'name': user.name,
+                'books': user_counts[str(user.id)][0]}
+               for user in users if user_counts[str(user.id)][0]])
+
+
+def get_page_args():
+    """Returns (after, limit) keyset pagination arguments of request.
+    Aborts with 400 on malformed arguments"""
+    try:
+        after = int(request.args.get('after', 0))
+        limit = int(request.args.get('limit',
+                                     current_app.config['PAGE_SIZE']))
+    except ValueError:
+        return abort(400)
+    if after < 0 or limit < 1:
+        return abort(400)
+    return after, min(limit, current_app.config['MAX_PAGE_SIZE'])
+
+
+def paginate_books(query, after, limit, key=None):
+    """Returns up to limit books with id greater than after, and id to
+    continue from (None on last page). Concurrent calls with the same key
+    share one query"""
+    books = query.filter(Book.id > after).order_by(Book.id).limit(limit + 1)
+    if key is None:
+        books = books.all()
+    else:
+        books = share_books(genre_page_loads, key + (after, limit), books.all)
+    if len(books) <= limit:
+        return books, None
+    return books[:limit], books[limit - 1].id
+
+
+def get_genre_page(genre_name, query, kind):
+    """Returns genre, its page of books from query, id to continue from
+    and page size. kind tells queries of different columns apart"""
+    genre = get_genre(genre_name)
+    if genre is None:
+        return abort(404)
+    after, limit = get_page_args()
+    genre_books, next_after = paginate_books(
+        query.filter(Book.genre_id == genre.id), after, limit,
+        key=(kind, genre.id))
+    return genre, genre_books, next_after, limit
 
 
-@app.route('/genre/<string:genre>/')
+@catalog.route('/genre/<string:genre>/')
+@response_cache.cached(genre_page_scope)
 def show_genre(genre):
-    genre = session.query(Genre).filter_by(name=genre).one()
-    genre_books = session.query(Book).filter_by(genre_id=genre.id)
+    # Version of cached book list is read before the books
+    genre_version = versions.get_request_version(genre_page_scope(genre))
+    genre, genre_books, next_after, limit = get_genre_page(
+        genre, query_books(), 'books')
+    next_url = None
+    if next_after is not None:
+        next_url = url_for('.show_genre', genre=genre.name,
+                           after=next_after, limit=limit)
+    genre_books_count, latest_book_id = stats.get_count(
+        session, stats.GENRE, str(genre.id))
     return render_template('genre.html',
                            genre=genre,
                            genre_books=genre_books,
+                           genre_books_count=genre_books_count,
+                           latest_book=serialize_latest_books(
+                               [latest_book_id]).get(latest_book_id),
+                           genre_version=genre_version,
+                           next_url=next_url,
                            login_session=login_session)
 
 
-@app.route('/genre/<string:genre>/json')
+@catalog.route('/genre/<string:genre>/json')
+@response_cache.cached(genre_page_scope, per_user=False)
+@versions.conditional(genre_page_scope)
 def show_genre_json(genre):
-    genre = session.query(Genre).filter_by(name=genre).one()
-    genre_books = session.query(Book).filter_by(genre_id=genre.id)
-    return jsonify(books=[book.serialize for book in genre_books])
+    genre, genre_books, next_after, limit = get_genre_page(
+        genre, serializers.query_book_rows(), 'rows')
+    next_url = None
+    if next_after is not None:
+        next_url = url_for('.show_genre_json', genre=genre.name,
+                           after=next_after, limit=limit)
+    return serializers.json_response(
+        books=serializers.serialize_rows(genre_books),
+        next_after=next_after,
+        next_url=next_url)
+
+
+def iter_books_batched(query, after, batch_size):
+    """Yields books (or book rows) of query with id greater than after,
+    fetching them from database in batches of batch_size, so memory usage
+    does not depend on number of books"""
+    while True:
+        books = query.filter(Book.id > after).order_by(Book.id)
+        books = books.limit(batch_size).all()
+        if not books:
+            return
+        for book in books:
+            yield book
+        after = books[-1].id
+
+
+def export_ndjson(books):
+    for book in books:
+        yield serializers.encode_row(book) + '\n'
+
+
+def export_json_array(books):
+    yield '['
+    separator = ''
+    for book in books:
+        yield separator + serializers.encode_row(book)
+        separator = ','
+    yield ']\n'
+
+
+EXPORT_FORMATS = {
+    'ndjson': (export_ndjson, 'application/x-ndjson'),
+    'json': (export_json_array, 'application/json'),
+}
+
+
+@catalog.route('/catalog/export')
+@query_budget.budget(None)
+def export_catalog():
+    """Streams all books ordered by id. Accepts optional arguments:
+    format (ndjson or json), genre (genre name) and since (book id)"""
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in EXPORT_FORMATS:
+        return abort(400)
+    try:
+        since = int(request.args.get('since', 0))
+    except ValueError:
+        return abort(400)
+
+    query = serializers.query_book_rows()
+    genre_name = request.args.get('genre')
+    if genre_name is not None:
+        genre_id = get_genre_id(genre_name)
+        if genre_id is None:
+            return abort(404)
+        query = query.filter(Book.genre_id == genre_id)
+
+    books = iter_books_batched(query, since,
+                               current_app.config['EXPORT_BATCH_SIZE'])
+    encode, mimetype = EXPORT_FORMATS[export_format]
+    return Response(stream_with_context(encode(books)), mimetype=mimetype)
+
 
+def changes_scope():
+    return versions.CHANGES
 
-@app.route('/genre/<string:genre>/new-book')
+
+@catalog.route('/changes/json')
+@versions.conditional(changes_scope)
+def show_changes_json():
+    """Returns book changes logged after since (sequence number), oldest
+    first. Every change carries current state of its book, or null if the
+    book no longer exists; continue from next while more is true"""
+    try:
+        since = int(request.args.get('since', 0))
+        limit = int(request.args.get('limit',
+                                     current_app.config['PAGE_SIZE']))
+    except ValueError:
+        return abort(400)
+    if since < 0 or limit < 1:
+        return abort(400)
+    limit = min(limit, current_app.config['MAX_PAGE_SIZE'])
+
+    entries = changes.get_changes(session, since, limit + 1)
+    more = len(entries) > limit
+    entries = entries[:limit]
+    book_ids = set(entry.book_id for entry in entries)
+    books = {}
+    if book_ids:
+        books = {row.id: serializers.serialize_row(row) for row in
+                 serializers.query_book_rows().filter(Book.id.in_(book_ids))}
+    return serializers.json_response(
+        changes=[{'seq': entry.seq, 'id': entry.book_id,
+                  'action': entry.action,
+                  'changed_at': entry.changed_at.isoformat(),
+                  'book': books.get(entry.book_id)}
+                 for entry in entries],
+        next=entries[-1].seq if entries else since,
+        more=more,
+        last_seq=changes.get_last_seq(session))
+
+
+def get_search_args():
+    """Returns (text, page, limit) search arguments of request.
+    Aborts with 400 on malformed arguments"""
+    text = request.args.get('q', '').strip()
+    try:
+        page = int(request.args.get('page', 1))
+        limit = int(request.args.get('limit',
+                                     current_app.config['PAGE_SIZE']))
+    except ValueError:
+        return abort(400)
+    if page < 1 or limit < 1:
+        return abort(400)
+    return text, page, min(limit, current_app.config['MAX_PAGE_SIZE'])
+
+
+def get_search_results(endpoint, query):
+    text, page, limit = get_search_args()
+    books, has_next = [], False
+    if text:
+        books, has_next = search.search_books(query, text,
+                                              page, limit)
+    prev_url = next_url = None
+    if page > 1:
+        prev_url = url_for(endpoint, q=text, page=page - 1, limit=limit)
+    if has_next:
+        next_url = url_for(endpoint, q=text, page=page + 1, limit=limit)
+    return text, books, prev_url, next_url
+
+
+@catalog.route('/search')
+def show_search():
+    text, books, prev_url, next_url = get_search_results('.show_search',
+                                                         query_books())
+    return render_template('search.html', query=text, books=books,
+                           prev_url=prev_url, next_url=next_url,
+                           login_session=login_session)
+
+
+@catalog.route('/search/json')
+def show_search_json():
+    text, books, prev_url, next_url = get_search_results(
+        '.show_search_json', serializers.query_book_rows())
+    return serializers.json_response(books=serializers.serialize_rows(books),
+                                     prev_url=prev_url,
+                                     next_url=next_url)
+
+
+@catalog.route('/autocomplete')
+def autocomplete_books():
+    """Returns books with title or author words starting with q"""
+    try:
+        limit = int(request.args.get('limit',
+                                     current_app.config['AUTOCOMPLETE_LIMIT']))
+    except ValueError:
+        return abort(400)
+    if limit < 1:
+        return abort(400)
+    books = autocomplete.index.complete(
+        request.args.get('q', ''),
+        min(limit, current_app.config['MAX_PAGE_SIZE']))
+    return serializers.json_response(results=[
+        {'id': book_id, 'title': title, 'author': author,
+         'url': url_for('.show_book',
+                        book_title=build_book_url(book_id, title))}
+        for book_id, title, author in books])
+
+
+@catalog.route('/genre/<string:genre>/new-book')
 @login_required
 def show_add_book(genre):
     return render_template('book_new.html', genre_name=genre,
                            login_session=login_session)
 
 
+def validate_book_data(data, partial=False):
+    """Validates book fields named as in Book.serialize. With partial only
+    given fields are validated
+    Returns (args_to_build_book, None) if all fields are valid,
+    Returns (None, error_message) otherwise"""
+    args = {}
+    for field in BOOK_FIELDS:
+        if partial and field not in data:
+            continue
+        value = data.get(field)
+        if not value:
+            return None, "Missing field: {}".format(field)
+        if field == 'year':
+            try:
+                args['year'] = int(value)
+            except (TypeError, ValueError):
+                return None, "Invalid year: {}".format(value)
+        elif not isinstance(value, str):
+            return None, "Invalid field: {}".format(field)
+        elif field == 'genre':
+            args['genre_id'] = get_genre_id(value)
+            if args['genre_id'] is None:
+                return None, "Unknown genre: {}".format(value)
+        else:
+            args[field] = value
+    # Optional, HTML forms do not have it
+    if data.get('author') is not None:
+        if not isinstance(data['author'], str):
+            return None, "Invalid field: author"
+        args['author'] = data['author']
+
+    if 'title' in args and not BOOK_TITLE_RE.match(args['title']):
+        logging.warning("Suspicious title: {}".format(args['title']))
+        return None, "Invalid title: {}".format(args['title'])
+
+    return args, None
+
+
 def validate_fields():
     """Validates form fields
     Returns (False, None) if some of the field is not valid,
     Returns (True, args_to_build_book) if all fields are valid """
-    title = request.form.get('book-title')
-    cover_url = request.form.get('book-image-url')
-    cover_url_attribution = request.form.get('book-image-url-attribution')
-    description = request.form.get('book-description')
-    year = request.form.get('book-year')
-    buy_url = request.form.get('book-buy-url')
-    genre_name = request.form.get('book-genre')
-
-    args = {'title': title,
-            'cover_url': cover_url,
-            'cover_url_attribution': cover_url_attribution,
-            'description': description,
-            'genre_id': get_genre_id(genre_name),
-            'year': year,
-            'buy_url': buy_url}
-
-    if not all(args.values()):
-        return False, None
-
-    if not BOOK_TITLE_RE.match(args['title']):
-        logging.warning("Suspicious title: {}".format(args['title']))
-        return False, None
+    data = {field: request.form.get(form_field)
+            for field, form_field in BOOK_FORM_FIELDS.items()}
+    args, error = validate_book_data(data)
+    return error is None, args
 
-    return True, args
 
-
-@app.route('/genre/<string:genre>/new-book', methods=["POST"])
+@catalog.route('/genre/<string:genre>/new-book', methods=["POST"])
 @login_required
+@query_budget.budget(WRITE_QUERY_BUDGET)
 def add_book_post_handler(genre):
     form_is_valid, book_args = validate_fields()
     if not form_is_valid:
@@ -143,84 +561,227 @@ def add_book_post_handler(genre):
     book_args['user_id'] = login_session['user_id']
     book = Book(**book_args)
     session.add(book)
-    session.commit()
+    session.flush()
+    commit_book_changes(book_scopes(book), [book.id])
     flash("Book successfully added")
-    return redirect(url_for('show_book', book_title=book.build_url()))
+    return redirect(url_for('.show_book', book_title=book.build_url()))
 
 
-@app.route('/book/<string:book_title>')
+@catalog.route('/book/<string:book_title>')
+@response_cache.cached(book_page_scope)
 def show_book(book_title):
-    book = get_book_by_title(book_title)
+    book = get_book_by_title(book_title, use_cache=True)
     if book is None:
         return abort(404)
     return render_template('book.html', book=book, login_session=login_session)
 
 
-@app.route('/book/<string:book_title>/json')
+@catalog.route('/book/<string:book_title>/json')
+@response_cache.cached(book_page_scope, per_user=False)
+@versions.conditional(book_page_scope)
 def show_book_json(book_title):
-    book = get_book_by_title(book_title)
+    book = get_book_by_title(book_title, use_cache=True)
     if book is None:
         return abort(404)
     return jsonify(book=book.serialize)
 
 
-@app.route('/book/<string:book_title>', methods=["POST"])
+@catalog.route('/book/<string:book_title>', methods=["POST"])
 def book_post_handler(book_title):
     edit = request.form.get('book-edit')
     delete = request.form.get('book-delete')
     if edit is not None:
-        return redirect(url_for('show_edit_book', book_title=book_title))
+        return redirect(url_for('.show_edit_book', book_title=book_title))
     elif delete is not None:
-        return redirect(url_for('show_delete_book', book_title=book_title))
+        return redirect(url_for('.show_delete_book', book_title=book_title))
     else:
         logging.warning("Suspicious request: {} (no action)".format(request))
 
 
-@app.route('/book/<string:book_title>/delete', methods=["GET", "POST"])
+@catalog.route('/book/<string:book_title>/delete', methods=["GET", "POST"])
 @login_required
+@query_budget.budget(WRITE_QUERY_BUDGET)
+@database.primary
 def show_delete_book(book_title):
     book = get_book_by_title(book_title)
     if book is None:
         return abort(404)
     if book.user_id != login_session.get('user_id'):
         flash("You should be author of this book entry to delete it", 'error')
-        return redirect(url_for('show_book', book_title=book.build_url()))
+        return redirect(url_for('.show_book', book_title=book.build_url()))
     if request.method == 'POST':
+        scopes = book_scopes(book)
         session.delete(book)
-        session.commit()
+        commit_book_changes(scopes, [book.id])
         flash("Book successfully deleted")
-        return redirect(url_for('show_homepage'))
+        return redirect(url_for('.show_homepage'))
     else:
         return render_template('book_delete.html', book=book,
                                login_session=login_session)
 
 
-@app.route('/book/<string:book_title>/edit', methods=["GET", "POST"])
+@catalog.route('/book/<string:book_title>/edit', methods=["GET", "POST"])
 @login_required
+@query_budget.budget(WRITE_QUERY_BUDGET)
+@database.primary
 def show_edit_book(book_title):
     book = get_book_by_title(book_title)
     if book is None:
         return abort(404)
     if book.user_id != login_session.get('user_id'):
         flash("You should be author of this book entry to edit it", 'error')
-        return redirect(url_for('show_book', book_title=book.build_url()))
+        return redirect(url_for('.show_book', book_title=book.build_url()))
     if request.method == 'POST':
         form_is_valid, book_args = validate_fields()
         if not form_is_valid:
             return abort(400)
 
+        scopes = book_scopes(book)
         for key, value in book_args.items():
             setattr(book, key, value)
 
         session.add(book)
-        session.commit()
+        session.flush()
+        # Genre may have changed, load the new one
+        session.expire(book, ['genre'])
+        commit_book_changes(scopes + book_scopes(book), [book.id])
         flash("Book successfully updated")
-        return redirect(url_for('show_book', book_title=book.build_url()))
+        return redirect(url_for('.show_book', book_title=book.build_url()))
     else:
         return render_template('book_edit.html', book=book,
                                login_session=login_session)
 
 
+def parse_book_ids(value):
+    """Returns list of book ids from comma separated string, or None"""
+    try:
+        return [int(book_id) for book_id in value.split(',') if book_id]
+    except ValueError:
+        return None
+
+
+def json_login_required(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user' in login_session:
+            return f(*args, **kwargs)
+        return make_json_response({'error': "Login required"}, 401)
+    return decorated_function
+
+
+@catalog.route('/books/json')
+def show_books_json():
+    book_ids = parse_book_ids(request.args.get('ids', ''))
+    if not book_ids or len(book_ids) > current_app.config['BATCH_MAX_BOOKS']:
+        return abort(400)
+    books = {book.id: book for book in serializers.query_book_rows().filter(
+        Book.id.in_(book_ids))}
+    return serializers.json_response(
+        books=[serializers.serialize_row(books[book_id])
+               for book_id in book_ids if book_id in books],
+        missing=[book_id for book_id in book_ids if book_id not in books])
+
+
+def validate_batch_item(item, books, user_id):
+    """Validates item of batch request against loaded books
+    Returns (args_to_build_or_update_book, None) if item is valid,
+    Returns (None, error_message) otherwise"""
+    if not isinstance(item, dict):
+        return None, "Operation must be an object"
+    action = item.get('action')
+    if action not in ('create', 'update', 'delete'):
+        return None, "Unknown action: {}".format(action)
+    data = item.get('book')
+    if data is None:
+        data = {}
+    if action != 'delete' and not isinstance(data, dict):
+        return None, "Book must be an object"
+    if action == 'create':
+        return validate_book_data(data)
+
+    book_id = item.get('id')
+    book = books.get(book_id) if isinstance(book_id, int) else None
+    if book is None:
+        return None, "No book with id {}".format(book_id)
+    if book.user_id != user_id:
+        return None, "You should be author of book {} to change it".format(
+            book.id)
+    if action == 'delete':
+        return {}, None
+    return validate_book_data(data, partial=True)
+
+
+@catalog.route('/books/batch', methods=["POST"])
+@json_login_required
+@query_budget.budget(None)
+def batch_books():
+    """Creates, updates and deletes books given as JSON
+    {"operations": [{"action": "create", "book": {...}},
+                    {"action": "update", "id": 1, "book": {...}},
+                    {"action": "delete", "id": 2}]}
+    in one transaction. Nothing is changed unless all operations are valid;
+    results are reported for every operation"""
+    data = request.get_json(silent=True)
+    operations = data.get('operations') if isinstance(data, dict) else None
+    if not isinstance(operations, list) or not operations or \
+            len(operations) > current_app.config['BATCH_MAX_BOOKS']:
+        return make_json_response({'error': "Expected up to {} operations"
+                                   .format(current_app.config[
+                                       'BATCH_MAX_BOOKS'])}, 400)
+
+    user_id = login_session['user_id']
+    book_ids = [item['id'] for item in operations
+                if isinstance(item, dict) and isinstance(item.get('id'), int)]
+    books = {}
+    if book_ids:
+        books = {book.id: book for book in
+                 session.query(Book).filter(Book.id.in_(book_ids)).all()}
+
+    validated = []
+    seen_ids = set()
+    for item in operations:
+        book_id = item.get('id') if isinstance(item, dict) else None
+        if isinstance(book_id, int) and item.get('action') != 'create':
+            if book_id in seen_ids:
+                validated.append((None, "Book {} is changed more than once"
+                                  .format(book_id)))
+                continue
+            seen_ids.add(book_id)
+        validated.append(validate_batch_item(item, books, user_id))
+    if any(error is not None for _, error in validated):
+        results = [{'index': index, 'error': error}
+                   if error is not None else {'index': index, 'ok': True}
+                   for index, (_, error) in enumerate(validated)]
+        return make_json_response({'committed': False,
+                                   'results': results}, 400)
+
+    genre_names = {genre.id: genre.name for genre in registry.genres.all()}
+    scopes = [versions.HOMEPAGE]
+    changed = []
+    for item, (book_args, _) in zip(operations, validated):
+        book = books.get(item.get('id'))
+        if book is not None:
+            scopes.append(versions.genre_scope(genre_names[book.genre_id]))
+        if item['action'] == 'create':
+            book = Book(user_id=user_id, **book_args)
+            session.add(book)
+        elif item['action'] == 'update':
+            for key, value in book_args.items():
+                setattr(book, key, value)
+        else:
+            session.delete(book)
+        changed.append(book)
+    session.flush()
+
+    results = []
+    for index, book in enumerate(changed):
+        scopes.append(versions.genre_scope(genre_names[book.genre_id]))
+        scopes.append(versions.book_scope(book.id))
+        results.append({'index': index, 'ok': True, 'id': book.id})
+    commit_book_changes(scopes, [book.id for book in changed])
+    return make_json_response({'committed': True, 'results': results}, 200)
+
+
 def make_auth_url(provider_name, provider_data):
     state = ''.join(
         random.choice(string.ascii_uppercase + string.digits)
@@ -238,30 +799,31 @@ def make_auth_url(provider_name, provider_data):
     return url
 
 
-@app.route('/login')
+@catalog.route('/login')
 def show_login():
     providers = []
-    for provider in OAUTH_PROVIDER_DATA:
+    provider_data = current_app.config['OAUTH_PROVIDER_DATA']
+    for provider in provider_data:
         providers.append({
             'name': provider,
-            'auth_url': make_auth_url(provider, OAUTH_PROVIDER_DATA[provider])
+            'auth_url': make_auth_url(provider, provider_data[provider])
         })
     return render_template('login.html', providers=providers,
                            login_session=login_session)
 
 
-@app.route('/logout/<provider>')
+@catalog.route('/logout/<provider>')
 def logout(provider):
     access_token = login_session[provider]['access_token']
     if access_token is None:
         return make_json_response("Current user not connected", 401)
 
-    if provider not in OAUTH_PROVIDER_DATA:
+    provider_data = current_app.config['OAUTH_PROVIDER_DATA'].get(provider)
+    if provider_data is None:
         logging.warning("Missing provider {}".format(provider))
         return make_json_response("No such provider", 500)
 
-    provider_data = OAUTH_PROVIDER_DATA[provider]
-
+    client = oauth_client.get_client(provider)
     headers = {
         "User-agent": USERAGENT,
     }
@@ -269,7 +831,7 @@ def logout(provider):
     try:
         if provider_data['revoke_method'] == 'GET':
             request_url = provider_data['revoke_url'] + "token=" + access_token
-            response = requests.get(request_url, headers=headers)
+            response = client.get(request_url, headers=headers)
         elif provider_data['revoke_method'] == 'POST':
             client_auth = HTTPBasicAuth(provider_data['client_id'],
                                         provider_data['client_secret'])
@@ -281,7 +843,7 @@ def logout(provider):
                 "token": login_session[provider]['access_token'],
             }
 
-            response = requests.post(
+            response = client.post(
                 provider_data['revoke_url'],
                 data=post_data,
                 auth=client_auth,
@@ -290,10 +852,10 @@ def logout(provider):
             response = requests.Response()
             response.status_code = 200
 
-    except requests.exceptions.ConnectionError as e:
+    except requests.exceptions.RequestException as e:
         flash(str(e), 'error')
         logging.exception("Failed logout")
-        return redirect(url_for('show_homepage'))
+        return redirect(url_for('.show_homepage'))
 
     if response.status_code == 200 or response.status_code == 204:
         login_session[provider].clear()
@@ -304,13 +866,13 @@ def logout(provider):
         del login_session['avatar']
 
         flash("Logout successful")
-        return redirect(url_for('show_homepage'))
+        return redirect(url_for('.show_homepage'))
     else:
         logging.warning(response.text)
         return make_json_response("Failed to revoke token for given user", 400)
 
 
-def get_oauth_token(provider_data, code):
+def get_oauth_token(provider_name, provider_data, code):
     client_auth = HTTPBasicAuth(provider_data['client_id'],
                                 provider_data['client_secret'])
     post_data = {
@@ -323,7 +885,7 @@ def get_oauth_token(provider_data, code):
         "Accept": "application/json",
     }
 
-    response = requests.post(
+    response = oauth_client.get_client(provider_name).post(
         provider_data['access_token_url'],
         auth=client_auth,
         data=post_data,
@@ -347,7 +909,8 @@ def retrieve_userinfo(token, provider_name, provider_data):
         "User-agent": USERAGENT,
     }
     request_url = provider_data['oauth_url'] + provider_data['user_request']
-    response = requests.get(request_url, headers=headers)
+    response = oauth_client.get_client(provider_name).get(request_url,
+                                                          headers=headers)
     user_json = response.json()
     if 'email' in user_json:
         login_session[provider_name]['email'] = user_json['email']
@@ -366,27 +929,33 @@ def retrieve_userinfo(token, provider_name, provider_data):
     login_session['avatar'] = user.picture
 
 
-@app.route('/callback/<provider>')
+@catalog.route('/callback/<provider>')
+@database.primary
 def sign_in_with_provider(provider):
-    if provider not in OAUTH_PROVIDER_DATA:
+    provider_data = current_app.config['OAUTH_PROVIDER_DATA'].get(provider)
+    if provider_data is None:
         logging.warning("Missing provider {}".format(provider))
         return make_json_response("No such provider", 500)
 
-    provider_data = OAUTH_PROVIDER_DATA[provider]
-
     if request.args.get('state') != login_session[provider]['state']:
         return make_json_response("Invalid state parameter", 401)
 
     code = request.args.get('code')
-    token = get_oauth_token(provider_data, code)
-    if token is None:
-        logging.warning("Failed obtaining access token")
-        return make_json_response("Cannot obtain oauth token", 500)
-
-    retrieve_userinfo(token, provider, provider_data)
+    try:
+        token = get_oauth_token(provider, provider_data, code)
+        if token is None:
+            logging.warning("Failed obtaining access token")
+            return make_json_response("Cannot obtain oauth token", 500)
+
+        retrieve_userinfo(token, provider, provider_data)
+    except requests.exceptions.RequestException:
+        logging.exception("Failed sign in with {}".format(provider))
+        return make_json_response("Provider is not available", 503)
+    # New session id after sign in, so ids known before are of no use
+    session_store.regenerate(login_session)
     flash("You are now logged in as {}".format(login_session['user']))
 
-    return redirect(url_for('show_homepage'))
+    return redirect(url_for('.show_homepage'))
 
 
 def create_user(login_session):
@@ -408,6 +977,7 @@ def create_user(login_session):
                     provider_id=user_provider_id)
     session.add(user)
     session.commit()
+    database.pin_primary()
     user = session.query(User).filter_by(
         provider=user_provider,
         provider_id=user_provider_id).one()
@@ -429,11 +999,38 @@ def get_user_by_provider(login_session):
         return None
 
 
-@app.errorhandler(404)
+@catalog.app_errorhandler(404)
 def page_not_found(e):
     return render_template('404.html', login_session=login_session), 404
 
 
+def create_app(config=None):
+    """Builds application. Settings from common.py can be overridden with
+    config given as a dict or as an object/import name"""
+    app = Flask(__name__)
+    app.config.from_object('common')
+    if isinstance(config, dict):
+        app.config.update(config)
+    elif config is not None:
+        app.config.from_object(config)
+
+    database.init_app(app)
+    session_store.init_app(app)
+    metrics.init_app(app)
+    query_budget.init_app(app)
+    response_cache.init_app(app)
+    oauth_client.init_app(app)
+    registry.init_app(app)
+    singleflight.init_app(app)
+    autocomplete.init_app(app)
+    assets.init_app(app)
+    covers.init_app(app)
+    template_cache.init_app(app)
+    app.register_blueprint(catalog)
+    return app
+
+
 if __name__ == "__main__":
+    app = create_app()
     app.debug = True
     app.run(host="0.0.0.0", port=8888)
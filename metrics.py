@@ -0,0 +1,258 @@
+import logging
+import threading
+import time
+from flask import g, has_request_context, request, current_app, Response
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import query_budget
+import response_cache
+import singleflight
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+        pairs.append('{}="{}"'.format(name, value.replace('\n', '\\n')))
+    return '{' + ','.join(pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, label_values=(), amount=1):
+        with self.lock:
+            self.values[label_values] = \
+                self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        for label_values, value in values:
+            yield self.name, format_labels(self.labels, label_values), value
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.description),
+                 "# TYPE {} counter".format(self.name)]
+        for name, labels, value in self.samples():
+            lines.append("{}{} {}".format(name, labels, format_value(value)))
+        return lines
+
+
+class Histogram(Counter):
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        Counter.__init__(self, name, description, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, label_values, value):
+        with self.lock:
+            counts = self.values.get(label_values)
+            if counts is None:
+                # counts of every bucket followed by sum and count
+                counts = self.values[label_values] = \
+                    [0] * len(self.buckets) + [0, 0]
+            for number, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[number] += 1
+                    break
+            counts[-2] += value
+            counts[-1] += 1
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.description),
+                 "# TYPE {} histogram".format(self.name)]
+        with self.lock:
+            values = sorted((key, list(counts))
+                            for key, counts in self.values.items())
+        for label_values, counts in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = format_labels(self.labels + ('le',),
+                                       label_values + (format_value(bound),))
+                lines.append("{}_bucket{} {}".format(self.name, labels,
+                                                     cumulative))
+            labels = format_labels(self.labels, label_values)
+            lines.append("{}_sum{} {}".format(self.name, labels,
+                                              format_value(counts[-2])))
+            lines.append("{}_count{} {}".format(self.name, labels,
+                                                counts[-1]))
+        return lines
+
+
+REQUESTS = Counter('catalog_requests_total', "Requests served",
+                   ('endpoint', 'method', 'status'))
+REQUEST_DURATION = Histogram('catalog_request_duration_seconds',
+                             "Time spent handling requests",
+                             ('endpoint', 'method'))
+SQL_QUERIES = Histogram('catalog_sql_queries_per_request',
+                        "SQL statements issued by a request", ('endpoint',),
+                        buckets=COUNT_BUCKETS)
+SQL_DURATION = Histogram('catalog_sql_duration_seconds',
+                         "Time spent in SQL statements per request",
+                         ('endpoint',))
+RENDER_DURATION = Histogram('catalog_template_render_duration_seconds',
+                            "Time spent rendering templates",
+                            ('template',))
+OAUTH_DURATION = Histogram('catalog_oauth_request_duration_seconds',
+                           "Time spent in requests to OAuth providers",
+                           ('provider',))
+OAUTH_ERRORS = Counter('catalog_oauth_request_errors_total',
+                       "Failed requests to OAuth providers", ('provider',))
+
+METRICS = [REQUESTS, REQUEST_DURATION, SQL_QUERIES, SQL_DURATION,
+           RENDER_DURATION, OAUTH_DURATION, OAUTH_ERRORS]
+
+
+def collect_response_cache():
+    counters = response_cache.stats.snapshot()
+    return [('catalog_response_cache_events_total',
+             "Response cache hits, misses, stores and invalidations",
+             {(('event', name),): value for name, value in counters.items()})]
+
+
+def collect_singleflight():
+    counters = singleflight.stats.snapshot()
+    return [('catalog_coalesced_calls_total',
+             "Reads run by a request (executed) or shared with a concurrent "
+             "identical one (coalesced)",
+             {(('call', name), ('event', event)): value
+              for (name, event), value in counters.items()})]
+
+
+# Functions returning (name, description, {label pairs: value}) of
+# counters maintained by other modules
+collectors = [collect_response_cache, collect_singleflight]
+
+
+def add_request_time(name, seconds):
+    if has_request_context():
+        setattr(g, name, g.get(name, 0.0) + seconds)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context,
+                      executemany):
+    conn.info.setdefault('query_started', []).append(time.time())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context,
+                     executemany):
+    seconds = time.time() - conn.info['query_started'].pop()
+    if not has_request_context():
+        return
+    add_request_time('sql_seconds', seconds)
+    statements = g.get('sql_statements')
+    if statements is not None:
+        statements.append((seconds, statement))
+
+
+def record_oauth_request(provider, seconds, failed):
+    OAUTH_DURATION.observe((provider,), seconds)
+    if failed:
+        OAUTH_ERRORS.inc((provider,))
+    add_request_time('oauth_seconds', seconds)
+
+
+class TimedTemplate(Template):
+    def render(self, *args, **kwargs):
+        started = time.time()
+        try:
+            return Template.render(self, *args, **kwargs)
+        finally:
+            seconds = time.time() - started
+            RENDER_DURATION.observe((self.name,), seconds)
+            add_request_time('render_seconds', seconds)
+
+
+def start_request():
+    g.request_started = time.time()
+    if current_app.config['SLOW_REQUEST_THRESHOLD'] is not None:
+        g.sql_statements = []
+
+
+def remember_status(response):
+    g.response_status = response.status_code
+    return response
+
+
+def finish_request(exception):
+    """Records request in teardown, which runs even when the view (or an
+    after_request function) raised and no response got to after_request"""
+    started = g.get('request_started')
+    if started is None:
+        return
+    seconds = time.time() - started
+    status = g.get('response_status', 500) if exception is None else 500
+    endpoint = request.endpoint or 'unmatched'
+    REQUESTS.inc((endpoint, request.method, status))
+    REQUEST_DURATION.observe((endpoint, request.method), seconds)
+    SQL_QUERIES.observe((endpoint,), query_budget.get_query_count())
+    SQL_DURATION.observe((endpoint,), g.get('sql_seconds', 0.0))
+
+    threshold = current_app.config['SLOW_REQUEST_THRESHOLD']
+    if threshold is not None and seconds >= threshold:
+        log_slow_request(seconds)
+
+
+def log_slow_request(seconds):
+    lines = ["Slow request {} {} ({}): {:.3f}s total, {:.3f}s in {} SQL "
+             "queries, {:.3f}s rendering, {:.3f}s in OAuth".format(
+                 request.method, request.full_path, request.endpoint,
+                 seconds, g.get('sql_seconds', 0.0),
+                 query_budget.get_query_count(),
+                 g.get('render_seconds', 0.0), g.get('oauth_seconds', 0.0))]
+    for query_seconds, statement in sorted(g.get('sql_statements', []),
+                                           reverse=True):
+        lines.append("  {:.3f}s {}".format(query_seconds,
+                                           ' '.join(statement.split())))
+    logging.warning('\n'.join(lines))
+
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for collect in collectors:
+        for name, description, values in collect():
+            counter = Counter(name, description, tuple(sorted(
+                {label for key in values for label, _ in key})))
+            for key, value in values.items():
+                counter.values[tuple(value for _, value in sorted(key))] = \
+                    value
+            lines.extend(counter.render())
+    return '\n'.join(lines) + '\n'
+
+
+def show_metrics():
+    return Response(render_metrics(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+def init_app(app):
+    app.jinja_env.template_class = TimedTemplate
+    app.before_request(start_request)
+    app.after_request(remember_status)
+    app.teardown_request(finish_request)
+    if app.config['METRICS_ENABLED']:
+        app.add_url_rule('/metrics', 'metrics', show_metrics)
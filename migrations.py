@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""Upgrades existing database schema in place, without dropping any data.
+
+Applied migrations are recorded in schema_version table. Run after every
+update of the application:
+
+    python3 migrations.py
+"""
+
+import datetime
+import logging
+from sqlalchemy import create_engine, inspect, select, func
+from sqlalchemy import MetaData, Table, Column, Integer, DateTime
+from common import DATABASE_PATH
+from database_setup import Base, Book, BookChange, CatalogStat
+from database_setup import BOOK_SEARCH_INDEX
+import changes
+import stats
+
+
+metadata = MetaData()
+schema_version = Table('schema_version', metadata,
+                       Column('version', Integer, primary_key=True,
+                              autoincrement=False),
+                       Column('applied_at', DateTime, nullable=False))
+
+
+def create_missing_tables(connection):
+    Base.metadata.create_all(connection)
+
+
+def add_book_created_at(connection):
+    columns = inspect(connection).get_columns('book')
+    if 'created_at' in [column['name'] for column in columns]:
+        return
+    column_type = Book.__table__.c.created_at.type.compile(
+        dialect=connection.dialect)
+    # SQLite does not allow non-constant defaults for added columns,
+    # existing books get current time below
+    connection.execute(
+        "ALTER TABLE book ADD COLUMN created_at {} NOT NULL "
+        "DEFAULT '1970-01-01 00:00:00'".format(column_type))
+    connection.execute(Book.__table__.update().values(
+        created_at=datetime.datetime.utcnow()))
+
+
+def create_missing_indexes(connection):
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        existing = [index['name'] for index in
+                    inspector.get_indexes(table.name)]
+        for index in table.indexes:
+            if index.name not in existing:
+                logging.info("Creating index {}".format(index.name))
+                index.create(connection)
+    BOOK_SEARCH_INDEX(Book.__table__, connection)
+
+
+def create_catalog_stats(connection):
+    CatalogStat.__table__.create(connection, checkfirst=True)
+    stats.rebuild(connection)
+
+
+def create_book_change_log(connection):
+    BookChange.__table__.create(connection, checkfirst=True)
+    # Writers lock this row, create it before any of them needs it
+    changes.lock_log(connection, datetime.datetime.utcnow())
+
+
+# Never edit or reorder applied migrations, only append new ones
+MIGRATIONS = [
+    create_missing_tables,
+    add_book_created_at,
+    create_missing_indexes,
+    create_catalog_stats,
+    create_book_change_log,
+]
+
+
+def get_version(connection):
+    schema_version.create(connection, checkfirst=True)
+    version = connection.scalar(select([func.max(schema_version.c.version)]))
+    return version or 0
+
+
+def record_version(connection, version):
+    connection.execute(schema_version.insert().values(
+        version=version, applied_at=datetime.datetime.utcnow()))
+
+
+def stamp(engine):
+    """Marks database as having all migrations applied"""
+    with engine.begin() as connection:
+        version = get_version(connection)
+        if version < len(MIGRATIONS):
+            record_version(connection, len(MIGRATIONS))
+
+
+def upgrade(engine):
+    """Applies pending migrations, each in its own transaction"""
+    with engine.begin() as connection:
+        version = get_version(connection)
+        fresh = 'book' not in inspect(connection).get_table_names()
+    if fresh:
+        create_missing_tables(engine)
+        stamp(engine)
+        return
+
+    for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+        logging.info("Applying migration {} ({})".format(
+            number, migration.__name__))
+        with engine.begin() as connection:
+            migration(connection)
+            record_version(connection, number)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    upgrade(create_engine(DATABASE_PATH))
+
+
+if __name__ == "__main__":
+    main()
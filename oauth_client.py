@@ -0,0 +1,109 @@
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+import metrics
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    """Raised instead of calling provider which keeps failing"""
+
+
+class ProviderClient(object):
+    """HTTP client of an OAuth provider. Keeps connections alive between
+    requests, bounds every request by timeouts, retries failed connections
+    and stops calling provider for reset_timeout seconds after
+    failure_threshold consecutive failures"""
+
+    def __init__(self, name, connect_timeout, read_timeout, retries,
+                 backoff_factor, pool_size, failure_threshold,
+                 reset_timeout):
+        self.name = name
+        self.timeout = (connect_timeout, read_timeout)
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None
+
+        # POST requests are retried only when connection was not made,
+        # authorization codes cannot be exchanged twice
+        retry = Retry(total=retries, backoff_factor=backoff_factor,
+                      status_forcelist=(502, 503, 504),
+                      method_whitelist=frozenset(['GET']),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                              max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def check_circuit(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.time() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(
+                    "Provider {} is unavailable".format(self.name))
+
+    def record_result(self, seconds, failed):
+        metrics.record_oauth_request(self.name, seconds, failed)
+        with self.lock:
+            if not failed:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.time()
+
+    def request(self, method, url, **kwargs):
+        self.check_circuit()
+        kwargs.setdefault('timeout', self.timeout)
+        started = time.time()
+        try:
+            response = self.session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            self.record_result(time.time() - started, failed=True)
+            raise
+        self.record_result(time.time() - started,
+                           failed=response.status_code >= 500)
+        return response
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+_clients = {}
+
+
+def make_client(name, provider_data, config):
+    """Builds client of provider. Settings may be overridden for a provider
+    by lowercase keys (e.g. 'read_timeout') in its OAUTH_PROVIDER_DATA"""
+    def setting(key):
+        return provider_data.get(key.lower(),
+                                 config['OAUTH_' + key.upper()])
+
+    return ProviderClient(name,
+                          connect_timeout=setting('connect_timeout'),
+                          read_timeout=setting('read_timeout'),
+                          retries=setting('retries'),
+                          backoff_factor=setting('retry_backoff'),
+                          pool_size=setting('pool_size'),
+                          failure_threshold=setting('circuit_failures'),
+                          reset_timeout=setting('circuit_reset'))
+
+
+def init_app(app):
+    _clients.clear()
+    for name, provider_data in app.config['OAUTH_PROVIDER_DATA'].items():
+        _clients[name] = make_client(name, provider_data, app.config)
+
+
+def get_client(provider_name):
+    return _clients[provider_name]
+
@@ -0,0 +1,59 @@
+import logging
+from flask import g, has_request_context, request, current_app
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+DEFAULT_QUERY_BUDGET = 10
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+
+def get_query_count():
+    """Returns number of SQL statements issued by current request"""
+    return g.get('query_count', 0)
+
+
+def budget(limit):
+    """Overrides the default query budget for a view.
+    Use None to disable budget check for the view entirely"""
+    def decorator(f):
+        f.query_budget = limit
+        return f
+    return decorator
+
+
+def get_view_budget(app):
+    view = app.view_functions.get(request.endpoint)
+    return getattr(view, 'query_budget', app.config['QUERY_BUDGET'])
+
+
+def init_app(app):
+    app.config.setdefault('QUERY_BUDGET', DEFAULT_QUERY_BUDGET)
+    app.config.setdefault('QUERY_BUDGET_STRICT', False)
+    app.config.setdefault('QUERY_COUNT_HEADER', False)
+
+    @app.after_request
+    def check_query_budget(response):
+        query_count = get_query_count()
+        if current_app.config['QUERY_COUNT_HEADER']:
+            response.headers['X-Query-Count'] = str(query_count)
+
+        budget = get_view_budget(current_app)
+        if budget is None or query_count <= budget:
+            return response
+
+        message = "{} issued {} queries (budget is {})".format(
+            request.endpoint, query_count, budget)
+        if current_app.config['QUERY_BUDGET_STRICT']:
+            raise QueryBudgetExceeded(message)
+        logging.warning(message)
+        return response
@@ -0,0 +1,108 @@
+import threading
+import time
+from collections import namedtuple, OrderedDict
+from database import session
+from database_setup import Genre
+import versions
+
+
+class GenreRecord(namedtuple('GenreRecord', 'id name description')):
+    __slots__ = ()
+
+    @property
+    def serialize(self):
+        return dict(self._asdict())
+
+
+class GenreRegistry(object):
+    """All genres of the catalog, kept in process memory. The genres
+    version is checked at most once per check_interval seconds, and
+    genres are reloaded when it changes"""
+
+    def __init__(self, check_interval=5):
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.genres = []
+        self.by_name = {}
+        self.version = None
+        self.checked_at = 0
+
+    def is_fresh(self):
+        return (self.version is not None and
+                time.time() - self.checked_at < self.check_interval)
+
+    def refresh(self):
+        if self.is_fresh():
+            return
+        with self.lock:
+            if self.is_fresh():
+                return
+            version = versions.get_version(session, versions.GENRES)
+            if version != self.version:
+                genres = session.query(Genre.id, Genre.name,
+                                       Genre.description).order_by(Genre.id)
+                self.genres = [GenreRecord(*genre) for genre in genres]
+                self.by_name = {genre.name: genre for genre in self.genres}
+                self.version = version
+            self.checked_at = time.time()
+
+    def all(self):
+        self.refresh()
+        return self.genres
+
+    def get(self, name):
+        """Returns genre record by name, or None if there is no such genre"""
+        self.refresh()
+        return self.by_name.get(name)
+
+
+class BookCache(object):
+    """Least recently used books, detached from sessions. Entries live at
+    most ttl seconds, since books may be changed by other processes"""
+
+    def __init__(self, max_entries=0, ttl=30):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, book_id):
+        if not self.max_entries:
+            return None
+        with self.lock:
+            entry = self.entries.get(book_id)
+            if entry is None:
+                return None
+            book, stored_at = entry
+            if time.time() - stored_at > self.ttl:
+                del self.entries[book_id]
+                return None
+            self.entries.move_to_end(book_id)
+        # Copy into current session without querying the database
+        return session.merge(book, load=False)
+
+    def set(self, book):
+        if not self.max_entries:
+            return
+        session.expunge(book)
+        with self.lock:
+            self.entries[book.id] = (book, time.time())
+            self.entries.move_to_end(book.id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, book_ids):
+        with self.lock:
+            for book_id in book_ids:
+                self.entries.pop(book_id, None)
+
+
+genres = GenreRegistry()
+books = BookCache()
+
+
+def init_app(app):
+    global genres, books
+    genres = GenreRegistry(app.config['GENRE_REGISTRY_CHECK_INTERVAL'])
+    books = BookCache(app.config['BOOK_CACHE_SIZE'],
+                      app.config['BOOK_CACHE_TTL'])
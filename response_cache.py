@@ -0,0 +1,231 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, current_app, request
+from flask import session as login_session
+import versions
+
+
+class MemoryBackend(object):
+    """Least recently used cache living in the process memory. Entries
+    expire after ttl seconds, if it is given"""
+
+    def __init__(self, max_entries, ttl=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, stored_at = entry
+            if self.ttl is not None and time.time() - stored_at > self.ttl:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.time())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete_prefix(self, prefix):
+        with self.lock:
+            for key in [k for k in self.entries if k.startswith(prefix)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class SQLiteBackend(object):
+    """Cache stored in SQLite database file, shared by all processes
+    of the app on the host. Entries expire after ttl seconds, if it is
+    given"""
+
+    EVICTION_INTERVAL = 100
+
+    def __init__(self, path, max_entries, ttl=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.local = threading.local()
+        self.writes = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def connect(self):
+        # sqlite3 connections cannot be shared between threads or processes
+        pid = os.getpid()
+        if getattr(self.local, 'pid', None) != pid:
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cached_response ("
+                "key TEXT PRIMARY KEY, mimetype TEXT, body BLOB, "
+                "headers TEXT, stored_at REAL)")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_cached_response_stored_at "
+                "ON cached_response (stored_at)")
+            connection.commit()
+            self.local.connection = connection
+            self.local.pid = pid
+        return self.local.connection
+
+    def get(self, key):
+        stored_after = 0 if self.ttl is None else time.time() - self.ttl
+        row = self.connect().execute(
+            "SELECT mimetype, body, headers FROM cached_response "
+            "WHERE key = ? AND stored_at >= ?",
+            (key, stored_after)).fetchone()
+        if row is None:
+            return None
+        return row[0], bytes(row[1]), json.loads(row[2])
+
+    def set(self, key, value):
+        mimetype, body, headers = value
+        connection = self.connect()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO cached_response "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, mimetype, body, json.dumps(headers), time.time()))
+        self.writes += 1
+        if self.writes % self.EVICTION_INTERVAL == 0:
+            self.evict()
+
+    def evict(self):
+        connection = self.connect()
+        with connection:
+            connection.execute(
+                "DELETE FROM cached_response WHERE key IN ("
+                "SELECT key FROM cached_response ORDER BY stored_at DESC "
+                "LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def delete_prefix(self, prefix):
+        connection = self.connect()
+        with connection:
+            connection.execute(
+                "DELETE FROM cached_response WHERE key >= ? AND key < ?",
+                (prefix, prefix + '\uffff'))
+
+    def clear(self):
+        connection = self.connect()
+        with connection:
+            connection.execute("DELETE FROM cached_response")
+
+
+class CacheStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'stores': 0,
+                         'invalidations': 0}
+
+    def incr(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+# Validators are kept along with cached responses, so conditional requests
+# are answered from cache too
+CACHED_HEADERS = ('ETag', 'Last-Modified')
+
+# Separates parts of cache keys; never appears in URLs or genre names
+KEY_SEPARATOR = '\x1f'
+
+_backend = None
+stats = CacheStats()
+
+
+def make_backend(config):
+    name = config['RESPONSE_CACHE_BACKEND']
+    if name == 'memory':
+        return MemoryBackend(config['RESPONSE_CACHE_SIZE'],
+                             config['RESPONSE_CACHE_TTL'])
+    if name == 'sqlite':
+        return SQLiteBackend(config['RESPONSE_CACHE_PATH'],
+                             config['RESPONSE_CACHE_SIZE'],
+                             config['RESPONSE_CACHE_TTL'])
+    raise ValueError("Unknown response cache backend: {}".format(name))
+
+
+def init_app(app):
+    global _backend
+    _backend = None
+    if app.config['RESPONSE_CACHE_ENABLED']:
+        _backend = make_backend(app.config)
+
+
+def get_variant():
+    user_id = login_session.get('user_id')
+    if user_id is None:
+        return 'anonymous'
+    return 'user-{}'.format(user_id)
+
+
+def cached(group, per_user=True):
+    """Caches successful GET responses of a view.
+    group is a function of view arguments returning name of the group
+    the response belongs to. Responses are cached under current version
+    of the group, read before the view queries anything, so changes
+    committed by any process are never hidden by cached pages; invalidate()
+    only frees memory of dropped groups early. Pages depending on logged
+    in user are cached separately for every user"""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if _backend is None or request.method != 'GET':
+                return f(*args, **kwargs)
+            # Pending flash messages are rendered once, never cache them
+            if per_user and '_flashes' in login_session:
+                return f(*args, **kwargs)
+
+            name = group(*args, **kwargs)
+            key = KEY_SEPARATOR.join([name,
+                                      str(versions.get_request_version(name)),
+                                      get_variant() if per_user else '',
+                                      request.full_path])
+            value = _backend.get(key)
+            if value is not None:
+                stats.incr('hits')
+                mimetype, body, headers = value
+                response = Response(body, mimetype=mimetype, headers=headers)
+                return response.make_conditional(request)
+
+            stats.incr('misses')
+            response = current_app.make_response(f(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                headers = [(name, response.headers[name])
+                           for name in CACHED_HEADERS
+                           if name in response.headers]
+                _backend.set(key, (response.mimetype, response.get_data(),
+                                   headers))
+                stats.incr('stores')
+            return response
+        return decorated_function
+    return decorator
+
+
+def invalidate(*groups):
+    """Drops cached responses of given groups"""
+    if _backend is None:
+        return
+    for group in set(groups):
+        _backend.delete_prefix(group + KEY_SEPARATOR)
+        stats.incr('invalidations')
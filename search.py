@@ -0,0 +1,103 @@
+import math
+import re
+import threading
+from collections import defaultdict
+from sqlalchemy import func, literal_column
+from database import session
+from database_setup import Book, BOOK_SEARCH_QUERY_DOCUMENT
+import versions
+
+
+WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    return WORD_RE.findall((text or '').lower())
+
+
+class InvertedIndex(object):
+    """In-process full-text index of books, used with databases lacking
+    full-text search. Rebuilt whenever catalog version changes"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = None
+        self.postings = {}
+        self.size = 0
+
+    def build(self, books):
+        postings = defaultdict(dict)
+        size = 0
+        for book_id, title, author, description in books:
+            size += 1
+            for term in tokenize(title) + tokenize(author) + \
+                    tokenize(description):
+                frequencies = postings[term]
+                frequencies[book_id] = frequencies.get(book_id, 0) + 1
+        self.postings = dict(postings)
+        self.size = size
+
+    def search(self, text):
+        """Returns ids of books containing all words of text, most relevant
+        first"""
+        terms = set(tokenize(text))
+        if not terms:
+            return []
+        postings = self.postings
+        matches = None
+        for term in terms:
+            book_ids = set(postings.get(term, ()))
+            matches = book_ids if matches is None else matches & book_ids
+            if not matches:
+                return []
+
+        scores = dict.fromkeys(matches, 0.0)
+        for term in terms:
+            frequencies = postings[term]
+            idf = math.log(1 + self.size / len(frequencies))
+            for book_id in matches:
+                scores[book_id] += frequencies[book_id] * idf
+        return sorted(matches, key=lambda book_id: (-scores[book_id],
+                                                    book_id))
+
+
+_index = InvertedIndex()
+
+
+def get_index():
+    version = versions.get_version(session, versions.HOMEPAGE)
+    if _index.version != version:
+        with _index.lock:
+            if _index.version != version:
+                _index.build(session.query(Book.id, Book.title, Book.author,
+                                           Book.description))
+                _index.version = version
+    return _index
+
+
+def search_postgresql(query, text, offset, limit):
+    document = literal_column(BOOK_SEARCH_QUERY_DOCUMENT)
+    tsquery = func.plainto_tsquery('english', text)
+    rank = func.ts_rank(document, tsquery)
+    return query.filter(document.op('@@')(tsquery)).order_by(
+        rank.desc(), Book.id).offset(offset).limit(limit).all()
+
+
+def search_inverted_index(query, text, offset, limit):
+    book_ids = get_index().search(text)[offset:offset + limit]
+    if not book_ids:
+        return []
+    books = {book.id: book
+             for book in query.filter(Book.id.in_(book_ids))}
+    return [books[book_id] for book_id in book_ids if book_id in books]
+
+
+def search_books(query, text, page, limit):
+    """Returns books of query matching text, most relevant first, and
+    whether there are more results after given page"""
+    if session.get_bind().dialect.name == 'postgresql':
+        search = search_postgresql
+    else:
+        search = search_inverted_index
+    books = search(query, text, (page - 1) * limit, limit + 1)
+    return books[:limit], len(books) > limit
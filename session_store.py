@@ -0,0 +1,240 @@
+import binascii
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from flask.sessions import SessionInterface, SessionMixin
+from flask.sessions import session_json_serializer
+
+
+SID_RE = re.compile(r'^[0-9a-f]{64}$')
+
+
+def generate_sid():
+    return binascii.hexlify(os.urandom(32)).decode('ascii')
+
+
+class MemoryStore(object):
+    """Sessions living in the process memory; the least recently saved
+    ones are dropped when there are more than max_entries"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, sid):
+        """Returns (data, expires_at) of session, or None"""
+        with self.lock:
+            entry = self.entries.get(sid)
+            if entry is None or entry[1] < time.time():
+                return None
+            return entry
+
+    def set(self, sid, data, expires_at):
+        with self.lock:
+            self.entries[sid] = (data, expires_at)
+            self.entries.move_to_end(sid)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, sid):
+        with self.lock:
+            self.entries.pop(sid, None)
+
+
+class SQLiteStore(object):
+    """Sessions stored in SQLite database file, shared by all processes
+    of the app on the host"""
+
+    EVICTION_INTERVAL = 100
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.writes = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def connect(self):
+        # sqlite3 connections cannot be shared between threads or processes
+        pid = os.getpid()
+        if getattr(self.local, 'pid', None) != pid:
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS session ("
+                "sid TEXT PRIMARY KEY, data TEXT, expires_at REAL)")
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_session_expires_at "
+                "ON session (expires_at)")
+            connection.commit()
+            self.local.connection = connection
+            self.local.pid = pid
+        return self.local.connection
+
+    def get(self, sid):
+        return self.connect().execute(
+            "SELECT data, expires_at FROM session "
+            "WHERE sid = ? AND expires_at >= ?",
+            (sid, time.time())).fetchone()
+
+    def set(self, sid, data, expires_at):
+        connection = self.connect()
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO session VALUES (?, ?, ?)",
+                (sid, data, expires_at))
+        self.writes += 1
+        if self.writes % self.EVICTION_INTERVAL == 0:
+            self.evict()
+
+    def evict(self):
+        connection = self.connect()
+        with connection:
+            connection.execute("DELETE FROM session WHERE expires_at < ?",
+                               (time.time(),))
+
+    def delete(self, sid):
+        connection = self.connect()
+        with connection:
+            connection.execute("DELETE FROM session WHERE sid = ?", (sid,))
+
+
+class ServerSession(SessionMixin, MutableMapping):
+    """Session data kept in a store under random id. Data is loaded on
+    first access, so requests not using the session do not touch the
+    store at all"""
+
+    def __init__(self, store, sid):
+        self.store = store
+        self.sid = sid
+        self.new = sid is None
+        self.regenerated = False
+        self.loaded = None
+        self.expires_at = None
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            entry = self.store.get(self.sid) if self.sid else None
+            if entry is None:
+                # Never reuse ids of unknown sessions, they could be
+                # chosen by someone else
+                self.sid = None
+                self.new = True
+                self._data = {}
+            else:
+                self.loaded, self.expires_at = entry
+                self._data = session_json_serializer.loads(self.loaded)
+        return self._data
+
+    @property
+    def accessed(self):
+        return self._data is not None
+
+    @property
+    def modified(self):
+        return self.accessed and self.serialize() != self.loaded
+
+    def serialize(self):
+        return session_json_serializer.dumps(self.data) if self.data \
+            else None
+
+    def regenerate(self):
+        """Moves session data under new id, e.g. to prevent session
+        fixation on login"""
+        self.data  # sessions are saved only when loaded
+        self.regenerated = True
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+
+    def __delitem__(self, key):
+        del self.data[key]
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+
+class ServerSessionInterface(SessionInterface):
+    """Keeps sessions in a store, sending only their ids in cookies.
+    Sessions expire after ttl seconds of inactivity"""
+
+    def __init__(self, store, ttl):
+        self.store = store
+        self.ttl = ttl
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(app.session_cookie_name)
+        if sid is None or not SID_RE.match(sid):
+            sid = None
+        return ServerSession(self.store, sid)
+
+    def save_session(self, app, session, response):
+        if not session.accessed:
+            return
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        data = session.serialize()
+        if data is None:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+                response.delete_cookie(app.session_cookie_name,
+                                       domain=domain, path=path)
+            return
+
+        now = time.time()
+        # Unchanged sessions are only rewritten to extend their lifetime,
+        # and not more often than once per half of ttl
+        if data == session.loaded and not session.regenerated and \
+                session.expires_at - now > self.ttl / 2:
+            return
+        if session.sid is None or session.regenerated:
+            if session.sid is not None:
+                self.store.delete(session.sid)
+            session.sid = generate_sid()
+            session.new = True
+        self.store.set(session.sid, data, now + self.ttl)
+        if session.new:
+            expires = self.get_expiration_time(app, session)
+            response.set_cookie(app.session_cookie_name, session.sid,
+                                expires=expires,
+                                httponly=self.get_cookie_httponly(app),
+                                domain=domain, path=path,
+                                secure=self.get_cookie_secure(app))
+
+
+def regenerate(session):
+    """Moves server-side session data under new id. Cookie sessions
+    are left as they are"""
+    session = getattr(session, '_get_current_object', lambda: session)()
+    if isinstance(session, ServerSession):
+        session.regenerate()
+
+
+def make_store(config):
+    name = config['SESSION_BACKEND']
+    if name == 'memory':
+        return MemoryStore(config['SESSION_MAX_ENTRIES'])
+    if name == 'sqlite':
+        return SQLiteStore(config['SESSION_PATH'])
+    raise ValueError("Unknown session backend: {}".format(name))
+
+
+def init_app(app):
+    if app.config['SESSION_BACKEND'] == 'cookie':
+        return
+    app.session_interface = ServerSessionInterface(make_store(app.config),
+                                                   app.config['SESSION_TTL'])
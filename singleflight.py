@@ -0,0 +1,81 @@
+import threading
+
+
+class Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class CoalesceStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+
+    def incr(self, name, event):
+        with self.lock:
+            key = (name, event)
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+stats = CoalesceStats()
+
+
+class Group(object):
+    """Runs a function once for all threads of the process calling it
+    with the same key at the same time: the first caller runs it, the
+    others wait and get its result (or its exception). Results are shared,
+    so they must not be changed by callers"""
+
+    def __init__(self, name, enabled=True):
+        self.name = name
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, f):
+        if not self.enabled:
+            return f()
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Call()
+        if not leader:
+            stats.incr(self.name, 'coalesced')
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        stats.incr(self.name, 'executed')
+        try:
+            call.result = f()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+
+groups = {}
+
+
+def group(name):
+    """Returns group of given name, creating it on first use"""
+    if name not in groups:
+        groups[name] = Group(name)
+    return groups[name]
+
+
+def init_app(app):
+    for name, coalescing_group in groups.items():
+        coalescing_group.enabled = app.config['REQUEST_COALESCING']
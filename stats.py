@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""Denormalized book counters.
+
+Numbers of books in the catalog, per genre, per year and per user, and the
+latest added book of the catalog and of every genre are kept in
+catalog_stat table, so reading them does not depend on catalog size. ORM
+changes of books update counters in the same transaction automatically;
+bulk inserts call add_book_rows(). If counters ever drift, rebuild them:
+
+    python3 stats.py --rebuild
+"""
+
+import argparse
+import logging
+from collections import Counter
+from sqlalchemy import create_engine, event, func, inspect, select, or_
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+from common import DATABASE_PATH
+from database_setup import Book, CatalogStat
+
+
+stat_table = CatalogStat.__table__
+book_table = Book.__table__
+
+TOTAL = 'total'
+GENRE = 'genre'
+YEAR = 'year'
+USER = 'user'
+# Latest book is kept for these kinds only
+LATEST_KINDS = (TOTAL, GENRE)
+TRACKED_COLUMNS = ('genre_id', 'year', 'user_id')
+
+
+def stat_keys(genre_id, year, user_id):
+    return [(TOTAL, ''),
+            (GENRE, str(genre_id)),
+            (YEAR, '' if year is None else str(year)),
+            (USER, str(user_id))]
+
+
+def book_keys(book):
+    return stat_keys(book.genre_id, book.year, book.user_id)
+
+
+def latest_book_query(kind, key):
+    query = select([func.max(book_table.c.id)])
+    if kind == GENRE:
+        query = query.where(book_table.c.genre_id == int(key))
+    return query.as_scalar()
+
+
+def add_to_counter(connection, kind, key, delta):
+    """Adds delta to counter, creating it if it does not exist. On
+    PostgreSQL this is a single upsert, so transactions creating the same
+    counter concurrently do not conflict; SQLite runs one writer at a time"""
+    if connection.dialect.name == 'postgresql':
+        insert = postgresql.insert(stat_table).values(
+            kind=kind, key=key, books=delta)
+        connection.execute(insert.on_conflict_do_update(
+            index_elements=[stat_table.c.kind, stat_table.c.key],
+            set_={'books': stat_table.c.books + insert.excluded.books}))
+        return
+    updated = connection.execute(stat_table.update().where(
+        (stat_table.c.kind == kind) & (stat_table.c.key == key)).values(
+            books=stat_table.c.books + delta)).rowcount
+    if not updated:
+        connection.execute(stat_table.insert().values(
+            kind=kind, key=key, books=delta))
+
+
+def apply_changes(connection, deltas, added=(), removed=()):
+    """Adds deltas to counters. added are (kind, key, book_id) of new
+    books, removed are the same of books gone from the group"""
+    for (kind, key), delta in sorted(deltas.items()):
+        if delta:
+            add_to_counter(connection, kind, key, delta)
+
+    for kind, key, book_id in added:
+        if kind not in LATEST_KINDS:
+            continue
+        connection.execute(stat_table.update().where(
+            (stat_table.c.kind == kind) & (stat_table.c.key == key) &
+            or_(stat_table.c.latest_book_id.is_(None),
+                stat_table.c.latest_book_id < book_id)).values(
+                    latest_book_id=book_id))
+    for kind, key, book_id in removed:
+        if kind not in LATEST_KINDS:
+            continue
+        connection.execute(stat_table.update().where(
+            (stat_table.c.kind == kind) & (stat_table.c.key == key) &
+            (stat_table.c.latest_book_id == book_id)).values(
+                latest_book_id=latest_book_query(kind, key)))
+
+
+def old_value(book, column):
+    history = inspect(book).attrs[column].history
+    if history.deleted:
+        return history.deleted[0]
+    return getattr(book, column)
+
+
+@event.listens_for(Session, 'before_flush')
+def collect_book_changes(session, flush_context, instances):
+    """Remembers counters of changed books before they change. New books
+    get ids and genres only during flush, they are counted after it"""
+    pending = session.info.setdefault('stat_changes', [])
+    for book in session.new:
+        if isinstance(book, Book):
+            pending.append((book, []))
+    for book in session.dirty:
+        if isinstance(book, Book) and session.is_modified(book):
+            old = [old_value(book, column) for column in TRACKED_COLUMNS]
+            pending.append((book, stat_keys(*old)))
+    for book in session.deleted:
+        if isinstance(book, Book):
+            pending.append((book, book_keys(book)))
+
+
+@event.listens_for(Session, 'after_flush')
+def count_book_changes(session, flush_context):
+    pending = session.info.pop('stat_changes', [])
+    if not pending:
+        return
+    deltas = Counter()
+    added = []
+    removed = []
+    for book, old_keys in pending:
+        new_keys = [] if book in session.deleted else book_keys(book)
+        for kind, key in old_keys:
+            if (kind, key) not in new_keys:
+                deltas[kind, key] -= 1
+                removed.append((kind, key, book.id))
+        for kind, key in new_keys:
+            if (kind, key) not in old_keys:
+                deltas[kind, key] += 1
+                added.append((kind, key, book.id))
+    apply_changes(session.connection(), deltas, added, removed)
+
+
+def add_book_rows(connection, rows):
+    """Counts books inserted without ORM, given as dicts of book columns
+    including ids"""
+    deltas = Counter()
+    latest = {}
+    for row in rows:
+        keys = stat_keys(row['genre_id'], row.get('year'), row['user_id'])
+        deltas.update(keys)
+        for key in keys:
+            latest[key] = max(latest.get(key, 0), row['id'])
+    apply_changes(connection, deltas, [
+        (kind, key, book_id) for (kind, key), book_id in latest.items()])
+
+
+def rebuild(connection):
+    """Recounts all counters from book table"""
+    connection.execute(stat_table.delete())
+    rows = []
+    total, latest = connection.execute(select([
+        func.count(book_table.c.id), func.max(book_table.c.id)])).first()
+    if total:
+        rows.append({'kind': TOTAL, 'key': '', 'books': total,
+                     'latest_book_id': latest})
+    for genre_id, books, latest in connection.execute(select([
+            book_table.c.genre_id, func.count(book_table.c.id),
+            func.max(book_table.c.id)]).group_by(book_table.c.genre_id)):
+        rows.append({'kind': GENRE, 'key': str(genre_id), 'books': books,
+                     'latest_book_id': latest})
+    for kind, column in ((YEAR, book_table.c.year),
+                         (USER, book_table.c.user_id)):
+        for value, books in connection.execute(select([
+                column, func.count(book_table.c.id)]).group_by(column)):
+            rows.append({'kind': kind,
+                         'key': '' if value is None else str(value),
+                         'books': books, 'latest_book_id': None})
+    if rows:
+        connection.execute(stat_table.insert(), rows)
+
+
+def get_counts(db_session, kind):
+    """Returns {key: (books, latest_book_id)} of given kind"""
+    return {key: (books, latest) for key, books, latest in db_session.query(
+        CatalogStat.key, CatalogStat.books,
+        CatalogStat.latest_book_id).filter_by(kind=kind)}
+
+
+def get_all_counts(db_session):
+    """Returns {kind: {key: (books, latest_book_id)}} of all kinds"""
+    counts = {TOTAL: {}, GENRE: {}, YEAR: {}, USER: {}}
+    for kind, key, books, latest in db_session.query(
+            CatalogStat.kind, CatalogStat.key, CatalogStat.books,
+            CatalogStat.latest_book_id):
+        counts.setdefault(kind, {})[key] = (books, latest)
+    return counts
+
+
+def get_count(db_session, kind, key=''):
+    """Returns (books, latest_book_id) of one group"""
+    row = db_session.query(CatalogStat.books, CatalogStat.latest_book_id) \
+        .filter_by(kind=kind, key=key).first()
+    return tuple(row) if row is not None else (0, None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintain book counters")
+    parser.add_argument('--rebuild', action='store_true', required=True,
+                        help="recount all counters from books")
+    parser.add_argument('--database', default=DATABASE_PATH)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    with create_engine(args.database).begin() as connection:
+        rebuild(connection)
+    logging.info("Book counters rebuilt")
+
+
+if __name__ == "__main__":
+    main()
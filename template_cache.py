@@ -0,0 +1,66 @@
+import os
+import tempfile
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+from response_cache import MemoryBackend, KEY_SEPARATOR
+
+
+class AtomicBytecodeCache(FileSystemBytecodeCache):
+    """Bytecode cache shared by worker processes. Files are replaced
+    atomically, so no process reads partially written bytecode"""
+
+    def dump_bytecode(self, bucket):
+        fd, path = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as bytecode_file:
+                bucket.write_bytecode(bytecode_file)
+            os.replace(path, self._get_cache_filename(bucket))
+        except OSError:
+            os.unlink(path)
+
+
+class FragmentCacheExtension(Extension):
+    """Adds {% cache key, ... %}...{% endcache %} tag, which renders its
+    body once per distinct key and then reuses it. Include versions of
+    pages the fragment belongs to in the key, so fragments are re-rendered
+    after books change. Views must read these versions before querying
+    the data, or a change committed in between would be cached under the
+    new version along with the old data"""
+
+    tags = set(['cache'])
+
+    def __init__(self, environment):
+        Extension.__init__(self, environment)
+        environment.extend(fragment_cache=None)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key_parts = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            key_parts.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        call = self.call_method('_render_cached', [nodes.List(key_parts)])
+        return nodes.CallBlock(call, [], [], body).set_lineno(lineno)
+
+    def _render_cached(self, key_parts, caller):
+        backend = self.environment.fragment_cache
+        if backend is None:
+            return caller()
+        key = KEY_SEPARATOR.join(str(part) for part in key_parts)
+        fragment = backend.get(key)
+        if fragment is None:
+            fragment = caller()
+            backend.set(key, fragment)
+        return fragment
+
+
+def init_app(app):
+    path = app.config['TEMPLATE_BYTECODE_CACHE_PATH']
+    if path is not None:
+        os.makedirs(path, exist_ok=True)
+        app.jinja_env.bytecode_cache = AtomicBytecodeCache(path)
+
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    if app.config['FRAGMENT_CACHE_SIZE']:
+        app.jinja_env.fragment_cache = \
+            MemoryBackend(app.config['FRAGMENT_CACHE_SIZE'])
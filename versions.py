@@ -0,0 +1,94 @@
+import calendar
+import datetime
+from functools import wraps
+from flask import current_app, g, request
+from database import session
+from database_setup import CatalogVersion
+
+
+HOMEPAGE = 'homepage'
+# Changes with the list of genres itself, not with books in them
+GENRES = 'genres'
+# Changes with every entry appended to the log of book changes
+CHANGES = 'changes'
+
+
+def genre_scope(genre_name):
+    return 'genre/' + genre_name
+
+
+def book_scope(book_id):
+    return 'book/{}'.format(book_id)
+
+
+def get_version(db_session, scope):
+    """Returns current version of scope, 0 if it was never changed"""
+    version = db_session.query(CatalogVersion.version).filter_by(
+        name=scope).scalar()
+    return version or 0
+
+
+def get_request_version(scope):
+    """Returns version of scope, fetched once per request. The row stays
+    in the session, so conditional() does not query it again"""
+    cached_versions = g.setdefault('catalog_versions', {})
+    if scope not in cached_versions:
+        version = session.query(CatalogVersion).get(scope)
+        cached_versions[scope] = version.version if version else 0
+    return cached_versions[scope]
+
+
+def bump(db_session, scopes):
+    """Increments versions of given scopes. Changes are committed along
+    with the rest of db_session transaction"""
+    # Seconds resolution is all Last-Modified header can carry
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    for scope in sorted(set(scopes)):
+        updated = db_session.query(CatalogVersion).filter_by(
+            name=scope).update({'version': CatalogVersion.version + 1,
+                                'updated_at': now},
+                               synchronize_session=False)
+        if not updated:
+            db_session.add(CatalogVersion(name=scope, version=1,
+                                          updated_at=now))
+
+
+def make_etag(version):
+    """Returns ETag of scope version, None stands for never changed one"""
+    if version is None:
+        return "0"
+    timestamp = calendar.timegm(version.updated_at.utctimetuple())
+    return "{}-{}".format(version.version, timestamp)
+
+
+def is_not_modified(version, etag):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    if request.if_modified_since is not None and version is not None:
+        return request.if_modified_since >= version.updated_at
+    return False
+
+
+def conditional(scope):
+    """Answers conditional GET requests to a view with 304 Not Modified
+    before the view runs, while scope version is unchanged. scope is a
+    function of view arguments returning scope name. Scopes never changed
+    (e.g. imported books) have no recorded version; they get ETag of
+    version 0 but no Last-Modified, which is unknown"""
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            version = session.query(CatalogVersion).get(scope(*args,
+                                                              **kwargs))
+            etag = make_etag(version)
+            if is_not_modified(version, etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.make_response(f(*args, **kwargs))
+            if response.status_code in (200, 304):
+                response.set_etag(etag)
+                if version is not None:
+                    response.last_modified = version.updated_at
+            return response
+        return decorated_function
+    return decorator